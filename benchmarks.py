@@ -0,0 +1,339 @@
+"""
+Benchmarks for the story pipeline.
+
+    python benchmarks.py summary --lines 60 --every 10 [--live [--offline]]
+    python benchmarks.py layout --sizes 10 100 1000 --frames 5
+    python benchmarks.py store --sizes 100 1000 2000
+    python benchmarks.py prompts [--budget 3000]
+    python benchmarks.py startup [--module bot] [--runs 5] [--target-ms 500]
+
+Token counts are estimated from the prompts the bot would send. With --live the
+same prompts are also sent to the configured OpenAI endpoint and timed; add
+--offline to send them to the local stub (openaiStub.py) instead, with
+--stub-latency and --stub-error-rate shaping its replies.
+"""
+import argparse
+import asyncio
+import glob
+import json
+import math
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+
+from llm_utils import estimate_tokens, close_client
+
+
+def corpus_lines() -> list:
+    lines = []
+    for path in glob.glob(os.path.join("Stories", "**", "*.json"), recursive=True):
+        with open(path, "r", encoding="utf-8") as f:
+            story_data = json.load(f)
+        lines += [line["text"] for line in story_data.get("lines", [])]
+    return lines or ["The story continues in an unexpected direction."]
+
+def synthetic_lines(num_lines: int) -> list:
+    base = corpus_lines()
+    return [base[i % len(base)] for i in range(num_lines)]
+
+def print_row(*columns):
+    print("".join(f"{str(c):>16}" for c in columns))
+
+async def timed(coro):
+    start = time.perf_counter()
+    result = await coro
+    return result, (time.perf_counter() - start) * 1000
+
+
+##########################################################
+######################## Summary #########################
+##########################################################
+
+async def bench_summary(num_lines: int, every: int, live: bool):
+    from liveStoryMem import (
+        SUMMARY_CHAR_LIMIT,
+        append_line,
+        build_enrichment_prompt,
+        build_story_summary_prompt,
+        build_rolling_summary_prompt,
+        enrich_new_line,
+        generate_story_summary,
+        update_rolling_summary,
+    )
+
+    lines = synthetic_lines(num_lines)
+    story_data = {"currentStoryText": lines[0], "lines": [], "storySummary": lines[0], "characters": [], "settings": []}
+
+    print_row("line", "full tokens", "rolling tokens", "enrich tokens", "full ms", "rolling ms", "enrich ms")
+    for line_number, line in enumerate(lines[1:], start=2):
+        summary = story_data["storySummary"]
+        append_line(story_data, line, "bench")
+        story_text = story_data["currentStoryText"]
+        full_tokens = estimate_tokens(build_story_summary_prompt(story_text))
+        rolling_tokens = estimate_tokens(build_rolling_summary_prompt(summary, [line]))
+        enrich_tokens = estimate_tokens(build_enrichment_prompt(story_data, line))
+
+        full_ms = rolling_ms = enrich_ms = "-"
+        if live:
+            _, full_ms = await timed(generate_story_summary(story_text))
+            _, rolling_ms = await timed(update_rolling_summary(summary, [line]))
+            enrichment, enrich_ms = await timed(enrich_new_line(story_data, line))
+            story_data["storySummary"] = enrichment.get("storySummary") or summary
+            full_ms, rolling_ms, enrich_ms = f"{full_ms:.0f}", f"{rolling_ms:.0f}", f"{enrich_ms:.0f}"
+        else:
+            # Without a model, assume the worst case: a summary that always hits the cap
+            story_data["storySummary"] = (summary + " " + line)[-SUMMARY_CHAR_LIMIT:]
+
+        if line_number % every == 0 or line_number == num_lines:
+            print_row(line_number, full_tokens, rolling_tokens, enrich_tokens, full_ms, rolling_ms, enrich_ms)
+
+
+##########################################################
+######################## Graphs ##########################
+##########################################################
+
+def synthetic_characters(count: int, opinions_each: int = 2, seed: int = 0) -> list:
+    rng = random.Random(seed)
+    characters = []
+    for i in range(count):
+        # Only opinions of earlier characters, so each frame adds exactly one node
+        others = rng.sample(range(i), min(opinions_each, i))
+        characters.append({
+            "name": f"Character {i}",
+            "description": "",
+            "status": "Active",
+            "traits": [],
+            "opinionsOf": [
+                {"characterName": f"Character {j}", "opinionText": "...", "trustLevel": rng.randint(0, 10)}
+                for j in others
+            ],
+        })
+    return characters
+
+def bench_layout(sizes: list, frames: int):
+    from graphRenderer import build_graph, compute_layout
+
+    print_row("characters", "cold ms/frame", "warm ms/frame", "max drift")
+    for size in sizes:
+        characters = synthetic_characters(size + frames)
+        cold_total = warm_total = 0.0
+        max_drift = 0.0
+        previous = compute_layout(build_graph(characters[:size]))
+        for frame in range(1, frames + 1):
+            G = build_graph(characters[:size + frame])
+
+            start = time.perf_counter()
+            compute_layout(G)
+            cold_total += time.perf_counter() - start
+
+            start = time.perf_counter()
+            positions = compute_layout(G, previous)
+            warm_total += time.perf_counter() - start
+
+            # How far nodes that were already on screen moved
+            for node, (x, y) in previous.items():
+                if node in positions:
+                    px, py = positions[node]
+                    max_drift = max(max_drift, math.hypot(px - x, py - y))
+            previous = positions
+
+        print_row(size, f"{cold_total / frames * 1000:.1f}", f"{warm_total / frames * 1000:.1f}", f"{max_drift:.3f}")
+
+def bench_store(sizes: list):
+    from storyIndex import StoryIndex
+
+    def linear_add(characters):
+        existing = []
+        for new_char in characters:
+            if not any(c["name"] == new_char["name"] for c in existing):
+                existing.append(new_char)
+        return existing
+
+    def linear_reverse_lookups(characters):
+        found = 0
+        for character in characters:
+            for opinion in character["opinionsOf"]:
+                reverse = next((c for c in characters if c["name"] == opinion["characterName"]), None)
+                if reverse and next((o for o in reverse["opinionsOf"] if o["characterName"] == character["name"]), None):
+                    found += 1
+        return found
+
+    def indexed_add(characters):
+        index = StoryIndex([])
+        for new_char in characters:
+            index.add_character(new_char)
+        return index
+
+    def indexed_reverse_lookups(index):
+        found = 0
+        for character in index.characters:
+            for opinion in character["opinionsOf"]:
+                if index.opinion(opinion["characterName"], character["name"]):
+                    found += 1
+        return found
+
+    print_row("characters", "linear add ms", "index add ms", "linear rev ms", "index rev ms")
+    for size in sizes:
+        characters = synthetic_characters(size, opinions_each=3)
+        # Re-adding everything once more exercises the duplicate check
+        incoming = characters + characters
+
+        start = time.perf_counter()
+        linear_add(incoming)
+        linear_add_ms = (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        index = indexed_add(incoming)
+        index_add_ms = (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        expected = linear_reverse_lookups(characters)
+        linear_rev_ms = (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        assert indexed_reverse_lookups(index) == expected
+        index_rev_ms = (time.perf_counter() - start) * 1000
+
+        print_row(size, f"{linear_add_ms:.1f}", f"{index_add_ms:.1f}", f"{linear_rev_ms:.1f}", f"{index_rev_ms:.1f}")
+
+
+
+##########################################################
+######################## Prompts #########################
+##########################################################
+
+def bench_prompts(budget: int):
+    from storyRanking import build_score_prompt, find_stories, load_story_data
+    from storyDigest import compact_story
+
+    print_row("story", "repr tokens", "compact tokens", "saved %", "prompt tokens")
+    total_repr = total_compact = 0
+    for path in find_stories():
+        story_data = load_story_data(path)
+        if not isinstance(story_data, dict) or "lines" not in story_data:
+            continue
+        # The scoring prompt used to embed repr(story_data) directly
+        repr_tokens = estimate_tokens(repr(story_data))
+        compact_tokens = estimate_tokens(compact_story(story_data, budget))
+        total_repr += repr_tokens
+        total_compact += compact_tokens
+        saved = 100 * (1 - compact_tokens / repr_tokens) if repr_tokens else 0
+        name = os.path.splitext(os.path.basename(path))[0][:15]
+        print_row(name, repr_tokens, compact_tokens, f"{saved:.0f}", estimate_tokens(build_score_prompt(story_data, budget)))
+
+    if total_repr:
+        print_row("total", total_repr, total_compact, f"{100 * (1 - total_compact / total_repr):.0f}", "")
+
+
+
+##########################################################
+######################## Startup #########################
+##########################################################
+
+# Only needed once a graph, video or request is actually produced
+DEFERRED_MODULES = ("cv2", "numpy", "matplotlib", "networkx", "openai", "httpx", "requests")
+
+def import_times(module: str) -> dict:
+    """
+    Cumulative microseconds per module from a fresh 'python -X importtime'.
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    if result.returncode != 0:
+        raise SystemExit(result.stderr)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # Top-level imports have the least indentation
+        depth = (len(name) - len(name.lstrip())) // 2
+        times.setdefault(name.strip(), (int(cumulative), depth))
+    return times
+
+def bench_startup(module: str, runs: int, target_ms: float):
+    totals = []
+    for _ in range(runs):
+        times = import_times(module)
+        totals.append(times[module][0] / 1000)
+
+    # The heaviest direct imports of the module from the last run
+    direct = sorted(((t, name) for name, (t, depth) in times.items() if depth == 1), reverse=True)
+    print_row("import", "cumulative ms")
+    for t, name in direct[:8]:
+        print_row(name[:15], f"{t / 1000:.1f}")
+
+    loaded = subprocess.run(
+        [sys.executable, "-c", f"import sys, {module}; print(' '.join(m for m in {DEFERRED_MODULES!r} if m in sys.modules))"],
+        capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+    ).stdout.split()
+
+    median = statistics.median(totals)
+    print()
+    print(f"import {module}: median {median:.0f} ms, min {min(totals):.0f} ms over {runs} runs (target {target_ms:.0f} ms)")
+    print(f"heavy modules loaded at import: {', '.join(loaded) or 'none'}")
+    if median > target_ms or loaded:
+        raise SystemExit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    summary = subparsers.add_parser("summary", help="Prompt tokens and latency per line for the summary and enrichment calls")
+    summary.add_argument("--lines", type=int, default=60)
+    summary.add_argument("--every", type=int, default=10)
+    summary.add_argument("--live", action="store_true", help="Also call the model and time each request")
+    summary.add_argument("--offline", action="store_true", help="Answer --live requests from the local OpenAI stub")
+    summary.add_argument("--stub-latency", default="lognormal:0.4,0.5", help="Stub latency: fixed:S, uniform:LOW,HIGH, exp:MEAN or lognormal:MEDIAN,SIGMA")
+    summary.add_argument("--stub-error-rate", type=float, default=0.0, help="Fraction of stub requests answered with a 429")
+
+    layout = subparsers.add_parser("layout", help="Graph layout time per timeline frame, cold vs warm-started")
+    layout.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000])
+    layout.add_argument("--frames", type=int, default=5)
+
+    store = subparsers.add_parser("store", help="Character dedupe and reverse-opinion lookups, linear scans vs index")
+    store.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 2000])
+
+    prompts = subparsers.add_parser("prompts", help="Story payload tokens in the scoring prompt, repr vs compact digest, over Stories/")
+    prompts.add_argument("--budget", type=int, default=3000)
+
+    startup = subparsers.add_parser("startup", help="Cold import time of the bot, from python -X importtime")
+    startup.add_argument("--module", default="bot")
+    startup.add_argument("--runs", type=int, default=5)
+    startup.add_argument("--target-ms", type=float, default=500)
+
+    args = parser.parse_args()
+
+    if args.benchmark == "layout":
+        bench_layout(args.sizes, args.frames)
+        return
+    if args.benchmark == "store":
+        bench_store(args.sizes)
+        return
+    if args.benchmark == "prompts":
+        bench_prompts(args.budget)
+        return
+    if args.benchmark == "startup":
+        bench_startup(args.module, args.runs, args.target_ms)
+        return
+
+    if getattr(args, "offline", False):
+        from llm_utils import configure_client
+        from openaiStub import OpenAIStub
+        configure_client(**OpenAIStub(args.stub_latency, args.stub_error_rate).client_options())
+
+    async def run():
+        try:
+            if args.benchmark == "summary":
+                await bench_summary(args.lines, args.every, args.live)
+        finally:
+            await close_client()
+
+    asyncio.run(run())
+
+if __name__ == "__main__":
+    main()
@@ -4,9 +4,44 @@ import discord
 from discord.ext import commands
 from dotenv import load_dotenv
 import os
-from liveStoryMem import *
-from llm_utils import *
-import json
+from liveStoryMem import (
+    active_stories,
+    add_finalisation_steps,
+    build_story_image_prompt,
+    close_enrichment_pipeline,
+    close_timeline,
+    create_story,
+    end_story,
+    enrichment_metrics,
+    finalisation_timings,
+    journal,
+    journal_session,
+    queue_new_line_by_id,
+    record_finalisation,
+    restore_active_stories,
+    save_image,
+    speculate_enrichment,
+)
+from llm_utils import (
+    close_client,
+    generate_final_image,
+    generate_final_line_candidates_list,
+    generate_next_line_candidates_list,
+    json_stats,
+    llm_cache,
+    llm_metrics,
+    metrics_text,
+    preload_client,
+    rate_limiter,
+    stream_next_line_candidates,
+)
+from graphRenderer import graph_renderer
+from storyArchive import story_archive
+from imageStore import image_store
+from taskGraph import TaskGraph
+from storySessions import SessionManager
+from pollEngine import POLL_REACTIONS, PollEngine
+from llmMetrics import MetricsServer, gauge_lines, set_current_story
 from random import randint, choice
 
 """ 
@@ -33,131 +68,470 @@ class StoryId():
 
 current_story_id = StoryId()
 poll_time = 30
+# Seconds to wait for a writer's line before the story is abandoned
+turn_timeout = 600
+# Enrich every poll option while the vote runs and keep only the winner's result
+speculative_enrichment = True
+# Post the poll at once and fill in each option as the model streams it
+stream_candidates = True
 
-personality = None
 default_personality_options = ["sad", "funny", "mysterious", "action-packed", "fantasy/sci-fi"]
-users = set()
-length = 0
-primed = False
+sessions = SessionManager()
+polls = PollEngine()
+# Prometheus text endpoint on localhost; 0 turns it off
+metrics_port = int(os.getenv("METRICS_PORT", 9108))
+metrics_server = None
+
+class ChannelContext():
+    """
+    Just enough of a command context to run a story in a channel without a
+    command message, e.g. when resuming after a restart.
+    """
+    def __init__(self, channel):
+        self.channel = channel
+        self.guild = getattr(channel, "guild", None)
+
+    async def send(self, *args, **kwargs):
+        return await self.channel.send(*args, **kwargs)
+
+stories_resumed = False
 
 @bot.event
 async def on_ready():
     print(f'Logged in as: {bot.user}')
+    global stories_resumed
+    if not stories_resumed:
+        stories_resumed = True
+        await preload_client()
+        await resume_stories()
+        await start_metrics_server()
+        indexed = await asyncio.to_thread(story_archive.backfill)
+        print(f"Indexed {indexed} archived stories")
+
+def bot_metrics_text() -> str:
+    lines = [f"discord_story_sessions {len(sessions)}"]
+    lines += gauge_lines("enrichment", {f'story_id="{story_id}"': metrics for story_id, metrics in enrichment_metrics().items()})
+    lines += gauge_lines("image_store", {"": image_store.stats()})
+    lines += gauge_lines("finalisation_seconds", {f'story_id="{story_id}"': timings for story_id, timings in finalisation_timings.items()})
+    return metrics_text() + "\n".join(lines) + "\n"
+
+async def start_metrics_server():
+    global metrics_server
+    if not metrics_port:
+        return
+    metrics_server = MetricsServer(bot_metrics_text, port=metrics_port)
+    try:
+        await metrics_server.start()
+    except OSError as e:
+        print(f"Can't serve metrics on port {metrics_port}: {e}")
+        metrics_server = None
+
+async def resume_stories():
+    """
+    Rebuild the stories that were in progress when the bot last stopped and
+    carry on writing them in their channels.
+    """
+    restored = restore_active_stories()
+    numeric_ids = [story_id for story_id in restored if isinstance(story_id, int)]
+    if numeric_ids:
+        current_story_id.id = max(current_story_id.id, *numeric_ids)
+
+    for story_id, info in restored.items():
+        channel = bot.get_channel(info["channelId"]) if info else None
+        if channel is None:
+            print(f"Can't resume story {story_id}: its channel is gone")
+            end_story(story_id)
+            continue
+        session = sessions.create_for(info["guildId"], info["channelId"], info["length"])
+        session.personality = info["personality"]
+        session.story_id = story_id
+        for user_id in info["userIds"]:
+            try:
+                session.users.add(await bot.fetch_user(user_id))
+            except discord.HTTPException:
+                print(f"Can't find user {user_id} for story {story_id}")
+        asyncio.create_task(run_session(ChannelContext(channel), session))
+        print(f"Resumed story {story_id}")
         
 @bot.command(brief="Start a new story with a given number of lines")
 async def story(ctx, lines: int = commands.parameter(
     default=5,
     description="The total number of lines in the story"
 )):
-    global length, primed, personality, users
-    length = lines
-    primed = True
-    personality = None
-    users = set()
-    await ctx.send(f"Story of length {length} lines initiated. Use !join to take part and !start to begin writing.")
+    session = sessions.get(ctx)
+    if session is not None and session.running:
+        await ctx.send("A story is already being written in this channel.")
+        return
+    session = sessions.create(ctx, lines)
+    await ctx.send(f"Story of length {session.length} lines initiated. Use !join to take part and !start to begin writing.")
    
 @bot.command(brief="Register as a writer for the story")
 async def join(ctx):
-    users.add(ctx.author)
+    session = sessions.get(ctx)
+    if session is None:
+        return
+    session.users.add(ctx.author)
+    if session.story_id is not None:
+        journal_session(session.story_id, session.to_dict())
     await ctx.send(f'{ctx.author.name} has joined the story!')
 
-@bot.command(brief="Set the tone of the story e.g. sad, funny, ...")
-async def personality(ctx, p: str):
-    global personality
-    personality = p
-    await ctx.send(f"Personality: {personality}")
+@bot.command(name="personality", brief="Set the tone of the story e.g. sad, funny, ...")
+async def set_personality(ctx, p: str):
+    session = sessions.get(ctx)
+    if session is None:
+        return
+    session.personality = p
+    await ctx.send(f"Personality: {session.personality}")
  
 @bot.command(brief="Begin writing the story")
 async def start(ctx):
-    if not primed:
+    session = sessions.get(ctx)
+    if session is None or session.running:
+        return
+    if not session.users:
+        await ctx.send("Nobody has joined yet. Use !join first.")
+        return
+    await run_session(ctx, session)
+
+@bot.command(brief="Stop the story being written in this channel")
+async def cancel(ctx):
+    session = sessions.get(ctx)
+    if session is None:
         return
-    global personality
-    channel = ctx.channel
+    if session.users and ctx.author not in session.users:
+        await ctx.send("Only the story's writers can cancel it.")
+        return
+    if session.task is not None:
+        session.cancelled = True
+        session.task.cancel()
+    else:
+        sessions.end(session)
+    await ctx.send("Story cancelled.")
+
+async def run_session(ctx, session):
+    session.running = True
+    session.task = asyncio.current_task()
+    try:
+        await write_story(ctx, session)
+    except asyncio.CancelledError:
+        # Shutting down keeps the journal so the story resumes; !cancel drops it
+        if not session.cancelled:
+            raise
+        if session.story_id is not None:
+            end_story(session.story_id)
+    finally:
+        if session.story_id is not None:
+            close_enrichment_pipeline(session.story_id)
+            close_timeline(session.story_id)
+        sessions.end(session)
+
+async def wait_for_line(ctx, session):
+    """
+    The next message from one of the session's writers in its channel, or
+    None if nobody writes one within turn_timeout. Commands and messages
+    without text (e.g. just an attachment) aren't lines.
+    """
     def check(msg):
-        return msg.author in users and msg.channel == channel
-    turn = 1
-    await ctx.send(f'Story time! Let\'s write {length} lines together! You start:')
-    message = await bot.wait_for('message', check=check)
-    id = current_story_id.get()
-    if personality is None:
-        # Randomly select out of a list
-        personality = choice(default_personality_options)
-    
-    create_story(id, message.content, personality, message.author.name)
-    print(f"Sent by {message.author.name}")
+        content = msg.content.strip()
+        return (msg.author in session.users and msg.channel == ctx.channel
+                and content != "" and not content.startswith(bot.command_prefix))
+    try:
+        return await bot.wait_for('message', check=check, timeout=turn_timeout)
+    except asyncio.TimeoutError:
+        await ctx.send(f"Nobody wrote a line for {turn_timeout / 60:g} minutes, so the story has been abandoned.")
+        return None
+
+async def write_story(ctx, session):
+    if session.story_id is None:
+        await ctx.send(f'Story time! Let\'s write {session.length} lines together! You start:')
+        message = await wait_for_line(ctx, session)
+        if message is None:
+            return
+        id = current_story_id.get()
+        session.story_id = id
+        if session.personality is None:
+            # Randomly select out of a list
+            session.personality = choice(default_personality_options)
+        
+        await create_story(id, message.content, session.personality, message.author.name)
+        journal_session(id, session.to_dict())
+        print(f"Sent by {message.author.name}")
+    else:
+        # Resumed from the journal
+        id = session.story_id
+        await ctx.send(f'Picking up "{active_stories[id]["title"]}" where we left off!')
+    # Tags every LLM request this task (and the tasks it starts) makes
+    set_current_story(id)
     
-    for _ in range(length - 1):
-        if turn == 0: # user
+    # Line 1 is the user's, then the bot writes the even lines and the users the odd ones
+    for line_number in range(len(active_stories[id]["lines"]) + 1, session.length + 1):
+        session.turn = 1 if line_number % 2 == 0 else 0
+        if session.turn == 0: # user
             await ctx.send('Your turn! What comes next?')
-            message = await bot.wait_for('message', check=lambda m: m.author in users)
+            message = await wait_for_line(ctx, session)
+            if message is None:
+                end_story(id)
+                return
             
-            add_new_line_and_update_by_id(id, message.content, message.author.name)
+            queue_new_line_by_id(id, message.content.strip(), message.author.name)
         else: # bot
-            reply = await generate_reply(id)
-            print(reply)
-            messages = json.loads(reply)
-            options = [m["text"] for m in messages]
-          
-            poll = await create_poll(ctx, f"You have {poll_time} seconds to vote ... ", options[0:3]) 
-            await asyncio.sleep(poll_time)         
-            result = await get_poll_result(ctx, poll)
-            
-            embed = discord.Embed(description=options[result], color=discord.Color.blue())
-            await ctx.send(embed=embed)
-
-            add_new_line_and_update_by_id(id, options[result], "bot")
-        
-        turn = 1 - turn
+            await bot_turn(ctx, id, {user.id for user in session.users})
     
     # finalise story
     await finalise(ctx, id)
     await ctx.send(f'The end!')
+    end_story(id)
     
-async def finalise(ctx, id):
-    story_context = active_stories[id]["currentStoryText"]
-    t = generate_final_line_candidates_list(story_context)
-    candidates = json.loads(t)
-    final = candidates[randint(0, len(candidates) - 1)]["text"]
-    story = story_context + " " + final
-    image = generate_final_image(story)
-    
-    embed = discord.Embed(title= active_stories[id]["title"], description=story, color=discord.Color.blue())
-    embed.set_image(url=image)
+async def bot_turn(ctx, id, voters=None):
+    """
+    Let the channel vote between the model's candidate lines and queue the winner.
+    Only the ids in voters count (anyone, if None); the poll closes as soon as
+    the result can't change.
+    """
+    speculation = speculate_enrichment(id, [], "bot") if speculative_enrichment else None
+    poll = None
+    try:
+        options = []
+        if stream_candidates:
+            poll, options = await create_streamed_poll(
+                ctx, f"You have {poll_time} seconds to vote ... ", stream_reply(id),
+                on_option=speculation.add if speculation else None, voters=voters,
+            )
+            if not options:
+                polls.close(poll.id)
+                await poll.delete()
+        if not options:
+            reply = await generate_reply(id)
+            print(reply)
+            options = [m["text"] for m in reply][0:3]
+          
+            poll = await create_poll(ctx, f"You have {poll_time} seconds to vote ... ", options, voters) 
+            if speculation:
+                for option in options:
+                    speculation.add(option)
+
+        result = await get_poll_result(ctx, poll, len(options))
+    except BaseException:
+        if speculation:
+            speculation.discard()
+        if poll is not None:
+            polls.close(poll.id)
+        raise
     
+    embed = discord.Embed(description=options[result], color=discord.Color.blue())
+    await ctx.send(embed=embed)
+
+    queue_new_line_by_id(id, options[result], "bot", speculation, result)
+
+search_page_size = 5
+
+@bot.command(brief="Search finished stories e.g. !search dragons genre:fantasy page:2",
+             help="Free text plus optional genre:, tone:, keyword:, author: and page: filters. Use !read <number> to see a story.")
+async def search(ctx, *, query: str = ""):
+    filters = {"genre": None, "tone": None, "keyword": None, "author": None}
+    page = 1
+    words = []
+    for word in query.split():
+        name, _, value = word.partition(":")
+        if value and name.lower() in filters:
+            filters[name.lower()] = value.replace("_", " ")
+        elif value and name.lower() == "page" and value.isdigit():
+            page = int(value)
+        else:
+            words.append(word)
+
+    results, total = await asyncio.to_thread(
+        story_archive.search, " ".join(words), page=page, per_page=search_page_size, **filters
+    )
+    if not results:
+        await ctx.send("No stories found.")
+        return
+
+    pages = (total + search_page_size - 1) // search_page_size
+    embed = discord.Embed(title=f"Stories (page {page}/{pages}, {total} found)", color=discord.Color.blue())
+    for r in results:
+        by = ", ".join(r["authors"]) or "unknown"
+        embed.add_field(
+            name=f"#{r['id']} {r['title'] or 'Untitled'}",
+            value=f"{r['genre'] or '?'} / {r['tone'] or '?'} by {by}, {r['line_count']} lines",
+            inline=False,
+        )
+    embed.set_footer(text="!read <number> to read a story")
     await ctx.send(embed=embed)
+
+@bot.command(brief="Read a finished story found with !search")
+async def read(ctx, archive_id: int):
+    story_data = await asyncio.to_thread(story_archive.load, archive_id)
+    if story_data is None:
+        await ctx.send(f"No archived story #{archive_id}.")
+        return
+    embed = discord.Embed(title=story_data.get("title", ""), description=story_data.get("currentStoryText", "")[:4096], color=discord.Color.blue())
+    await ctx.send(embed=embed)
+
+@bot.command(brief="Show LLM latency, token and cost stats (admins only)")
+@commands.has_permissions(administrator=True)
+async def stats(ctx):
+    summary = llm_metrics.summary()
+    lines = [f"{'call site':<34}{'calls':>6}{'p50 s':>7}{'p95 s':>7}{'tokens':>9}{'cost $':>9}"]
+    for name, call in sorted(summary["calls"].items(), key=lambda item: -item[1]["costUsd"]):
+        tokens = call["promptTokens"] + call["completionTokens"]
+        lines.append(f"{name[:33]:<34}{call['calls']:>6}{call['p50Seconds']:>7}{call['p95Seconds']:>7}{tokens:>9}{call['costUsd']:>9.4f}")
+
+    lines.append("")
+    lines.append(f"{'story':<10}{'calls':>6}{'mean s':>8}{'tokens':>9}{'cost $':>9}")
+    stories = sorted(summary["stories"].items(), key=lambda item: -item[1]["costUsd"])[:10]
+    for story_id, story in stories:
+        tokens = story["promptTokens"] + story["completionTokens"]
+        lines.append(f"{story_id[:9]:<10}{story['calls']:>6}{story['meanSeconds']:>8}{tokens:>9}{story['costUsd']:>9.4f}")
+
+    lines.append("")
+    lines.append(f"cache: {llm_cache.stats()}")
+    lines.append(f"rate limiter: {rate_limiter.stats()}")
+    lines.append(f"image store: {image_store.stats()}")
+    for call_site, counters in json_stats.items():
+        lines.append(f"json {call_site}: {counters}")
+    for story_id, metrics in enrichment_metrics().items():
+        lines.append(f"enrichment {story_id}: {metrics}")
+    for story_id, timings in list(finalisation_timings.items())[-5:]:
+        lines.append(f"finalisation {story_id}: {timings}")
+
+    text = "\n".join(lines)
+    await ctx.send(f"```\n{text[:1900]}\n```")
+
+async def finalise(ctx, id):
+    """
+    Pick the closing line, illustrate it and post the finished story under
+    its regenerated title, then finish its summary and timeline video and
+    save it to the archive. The post only waits for the closing line, the
+    image and the title; the rest overlaps with it.
+    """
+    story_data = active_stories[id]
+    story_context = story_data["currentStoryText"]
+
+    async def final_line():
+        candidates = await generate_final_line_candidates_list(story_context)
+        return candidates[randint(0, len(candidates) - 1)]["text"]
+
+    async def line(final):
+        queue_new_line_by_id(id, final, "bot")
+
+    async def image(final):
+        # A refused or failed image still leaves the story to post and save
+        try:
+            return await generate_final_image(build_story_image_prompt(story_context + " " + final))
+        except Exception as e:
+            print(f"Couldn't generate the final image: {e!r}")
+            return None
+
+    async def stored_image(image):
+        # The DALL-E URL expires, so keep a copy to attach its thumbnail
+        if image is None:
+            return None
+        try:
+            return await save_image(story_data, image)
+        except Exception as e:
+            print(f"Couldn't save the final image: {e!r}")
+            return None
+
+    graph = TaskGraph()
+    graph.add("final_line", final_line)
+    graph.add("line", line, after=["final_line"])
+    graph.add("image", image, after=["final_line"])
+    graph.add("stored_image", stored_image, after=["image"])
+    add_finalisation_steps(graph, id, after=["line"], save_after=["stored_image"])
+
+    async def post(final, image, stored, _):
+        embed = discord.Embed(title= story_data["title"], description=story_context + " " + final, color=discord.Color.blue())
+        files = []
+        if image is not None:
+            embed.set_image(url=image)
+        if stored is not None:
+            files.append(discord.File(stored["thumbnail"], filename="thumbnail.png"))
+            embed.set_thumbnail(url="attachment://thumbnail.png")
+        await ctx.send(embed=embed, files=files)
+
+    graph.add("post", post, after=["final_line", "image", "stored_image", "metadata"])
+    await graph.run()
+    record_finalisation(id, graph)
     
     
 
-async def create_poll(ctx, question, options):
+@bot.event
+async def on_raw_reaction_add(payload):
+    if payload.user_id != bot.user.id:
+        polls.handle(payload.message_id, payload.user_id, str(payload.emoji), added=True)
+
+@bot.event
+async def on_raw_reaction_remove(payload):
+    if payload.user_id != bot.user.id:
+        polls.handle(payload.message_id, payload.user_id, str(payload.emoji), added=False)
+
+async def create_poll(ctx, question, options, voters=None):
     embed = discord.Embed(title=f"What happens next? {question}", color=0x00ff00)
-    reactions = ['1️⃣', '2️⃣', '3️⃣']
+    reactions = POLL_REACTIONS
     
     for i, option in enumerate(options):
         embed.add_field(name=f'Option {i + 1}', value=option, inline=False)
     
     poll_message = await ctx.send(embed=embed)
+    # Votes are counted from reaction events from here on
+    polls.open(poll_message.id, voters)
     
     for i in range(len(options)):
         await poll_message.add_reaction(reactions[i])
     
     return poll_message
 
-async def get_poll_result(ctx, poll_message):
-    poll_message = await ctx.channel.fetch_message(poll_message.id)
-    results = {reaction.emoji: reaction.count - 1 for reaction in poll_message.reactions}  # Subtract 1 to exclude the bot's own reaction
-    max_votes = 0
-    poll_response = ""
-    
-    for answer, votes in results.items():
-        if votes > max_votes:
-            max_votes = votes
-            poll_response = answer
+async def create_streamed_poll(ctx, question, candidates, count=3, on_option=None, voters=None):
+    """
+    Post the poll straight away with placeholder options and fill each one in
+    (with its reaction) as soon as its candidate has been streamed.
+    Returns the poll message and the options that arrived.
+    """
+    embed = discord.Embed(title=f"What happens next? {question}", color=0x00ff00)
+    reactions = POLL_REACTIONS
 
-    if max_votes == 0:
-        return randint(0, 2)
-    
-    reactions = ['1️⃣', '2️⃣', '3️⃣']
-    return reactions.index(poll_response)
+    for i in range(count):
+        embed.add_field(name=f'Option {i + 1}', value='...', inline=False)
+
+    poll_message = await ctx.send(embed=embed)
+    polls.open(poll_message.id, voters)
+
+    options = []
+    try:
+        while len(options) < count:
+            try:
+                option = await candidates.__anext__()
+            except StopAsyncIteration:
+                break
+            except Exception as e:
+                # Keep what arrived; with nothing, bot_turn falls back to a plain request
+                print(f"Candidate stream failed after {len(options)} options: {e!r}")
+                break
+            i = len(options)
+            options.append(option)
+            if on_option:
+                on_option(option)
+            embed.set_field_at(i, name=f'Option {i + 1}', value=option, inline=False)
+            await poll_message.edit(embed=embed)
+            await poll_message.add_reaction(reactions[i])
+    finally:
+        await candidates.aclose()
+
+    if len(options) < count:
+        # The model returned fewer candidates than asked for
+        for i in reversed(range(len(options), count)):
+            embed.remove_field(i)
+        await poll_message.edit(embed=embed)
+
+    return poll_message, options
+
+async def get_poll_result(ctx, poll_message, option_count=3):
+    """
+    Wait up to poll_time for the votes counted from reaction events, closing
+    early once everyone has voted or the lead can't be caught.
+    """
+    return await polls.result(poll_message.id, poll_time, option_count)
 
 # @bot.command()
 # async def story_user(ctx,
@@ -189,16 +563,32 @@ async def get_poll_result(ctx, poll_message):
         
 #     await ctx.send(f'Received: {chat_history}')
 
+def stream_reply(story_id: int):
+    return stream_next_line_candidates(
+        active_stories[story_id]['currentStoryText'],
+        personality=active_stories[story_id]['storyMetadata']['promptPersonality'],
+    )
+
 async def generate_reply(story_id: int):
-    return generate_next_line_candidates_list(
+    return await generate_next_line_candidates_list(
         active_stories[story_id]['currentStoryText'],
-        active_stories[story_id]['storyMetadata']['promptPersonality'],
+        personality=active_stories[story_id]['storyMetadata']['promptPersonality'],
     )
         
 
-def main():
+async def main():
     load_dotenv()
-    bot.run(os.getenv('BOT_TOKEN'))
+    try:
+        async with bot:
+            await bot.start(os.getenv('BOT_TOKEN'))
+    finally:
+        if metrics_server is not None:
+            await metrics_server.close()
+        await close_client()
+        await image_store.close()
+        graph_renderer.close()
+        journal.close()
+        story_archive.close()
 
 if __name__ == '__main__':
     asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,386 @@
+"""
+Offline load test for the bot: simulated channels and users drive the real
+command handlers through bot.dispatch, with fake Discord REST calls and
+reaction events standing in for the gateway.
+
+    python discordSim.py --channels 20 --users 3 --lines 6 --poll-seconds 5
+
+Each channel runs !story, !join (every user), !start, then the users write
+their lines and vote on every poll. Reported:
+    turn latency   from a user's action to the bot being ready for the next
+                   one (the next prompt, or the first poll option), and from
+                   the last vote to the poll result
+    loop lag       how late a 10 ms timer fires on the event loop
+    memory         RSS growth per concurrently active story
+
+OpenAI requests are answered by the local stub in openaiStub.py unless --live
+is given. Everything the bot writes (journal, archive, graphs, cache) goes to
+a temporary working directory.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+import types
+
+import discord
+from openaiStub import OpenAIStub, stub_sentence
+
+
+_ids = itertools.count(1_000_000)
+
+def next_id() -> int:
+    return next(_ids)
+
+
+##########################################################
+######################## Fake Discord ####################
+##########################################################
+
+class SimUser():
+    def __init__(self, name: str, bot: bool = False):
+        self.id = next_id()
+        self.name = name
+        self.display_name = name
+        self.bot = bot
+        self.mention = f"<@{self.id}>"
+
+class SimGuild():
+    def __init__(self):
+        self.id = next_id()
+
+class SimMessage():
+    def __init__(self, gateway, channel, author, content: str = "", embeds: list = None):
+        self.id = next_id()
+        self._state = gateway
+        self.gateway = gateway
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = author
+        self.content = content or ""
+        self.embeds = embeds or []
+        self.reactions = []
+        self.attachments = []
+        self.stickers = []
+        self.mentions = []
+        self.role_mentions = []
+        self.channel_mentions = []
+        self.mention_everyone = False
+        self.webhook_id = None
+        self.interaction = None
+        self.interaction_metadata = None
+
+    @property
+    def title(self) -> str:
+        return self.embeds[0].get("title", "") if self.embeds else ""
+
+    async def add_reaction(self, emoji):
+        await self.gateway.rest()
+        self.reactions.append(str(emoji))
+        self.channel.on_reaction_added(self)
+
+    async def edit(self, content=None, embed=None, **kwargs):
+        await self.gateway.rest()
+        if content is not None:
+            self.content = content
+        if embed is not None:
+            self.embeds = [embed.to_dict()]
+        return self
+
+    async def delete(self, **kwargs):
+        await self.gateway.rest()
+
+class SimChannel():
+    def __init__(self, gateway, guild):
+        self.id = next_id()
+        self.gateway = gateway
+        self.guild = guild
+        self.type = discord.ChannelType.text
+        self.story = None
+
+    async def _get_channel(self):
+        return self
+
+    async def send(self, content=None, embed=None, **kwargs):
+        # Used by ChannelContext; Context.send reaches the gateway through Messageable.send
+        payload = {"content": content, "embeds": [embed.to_dict()] if embed else []}
+        await self.gateway.rest()
+        return self.gateway.create_message(self, payload)
+
+    def on_reaction_added(self, message):
+        if self.story is not None:
+            self.story.on_bot_reaction(message)
+
+class SimGateway():
+    """
+    Stands in for discord.py's ConnectionState and HTTP client: the REST calls
+    the bot makes take rest_latency seconds and create SimMessages, and the
+    users' messages and reactions are dispatched as gateway events.
+    """
+    def __init__(self, bot, rest_latency: float = 0.05):
+        self.bot = bot
+        self.http = self
+        self.allowed_mentions = None
+        self.rest_latency = rest_latency
+        self.bot_user = SimUser("StoryBot", bot=True)
+        self.rest_calls = 0
+
+    async def rest(self):
+        self.rest_calls += 1
+        await asyncio.sleep(random.uniform(0.5, 1.5) * self.rest_latency)
+
+    # Called by Messageable.send
+    async def send_message(self, channel_id, params):
+        await self.rest()
+        if params.payload is None:
+            # Sent with files: the message is the multipart's JSON part
+            return json.loads(params.multipart[0]["value"])
+        return params.payload
+
+    def create_message(self, channel, data):
+        message = SimMessage(self, channel, self.bot_user, data.get("content") or "", data.get("embeds") or [])
+        if channel.story is not None:
+            channel.story.on_bot_message(message)
+        return message
+
+    def store_view(self, view, message_id):
+        pass
+
+    def user_message(self, channel, author, content: str):
+        self.bot.dispatch("message", SimMessage(self, channel, author, content))
+
+    def reaction(self, message, user, emoji: str, added: bool = True):
+        payload = types.SimpleNamespace(
+            message_id=message.id, channel_id=message.channel.id, guild_id=message.guild.id,
+            user_id=user.id, emoji=emoji, event_type="REACTION_ADD" if added else "REACTION_REMOVE",
+        )
+        self.bot.dispatch("raw_reaction_add" if added else "raw_reaction_remove", payload)
+
+
+##########################################################
+######################## Simulation ######################
+##########################################################
+
+class SimStory():
+    """
+    One channel's users: they answer every prompt after a think time and
+    vote on every poll, and time how long the bot keeps them waiting.
+    """
+    def __init__(self, gateway, channel, users, lines: int, think: float, rng):
+        self.gateway = gateway
+        self.channel = channel
+        self.users = users
+        self.lines = lines
+        self.think = think
+        self.rng = rng
+        self.waiting_since = None
+        self.waiting_kind = None
+        self.latencies = []
+        self.voted_polls = set()
+        self.done = asyncio.Event()
+        channel.story = self
+
+    def act(self, kind: str):
+        self.waiting_since = time.perf_counter()
+        self.waiting_kind = kind
+
+    def ready(self):
+        if self.waiting_since is not None:
+            self.latencies.append((self.waiting_kind, time.perf_counter() - self.waiting_since))
+            self.waiting_since = None
+
+    def think_time(self) -> float:
+        return self.rng.uniform(0.5, 1.5) * self.think
+
+    def on_bot_message(self, message):
+        content = message.content
+        if content.startswith("Story time!") or content.startswith("Your turn!"):
+            self.ready()
+            asyncio.create_task(self.write_line())
+        elif message.title.startswith("What happens next?"):
+            # The poll is ready once its first option can be voted for
+            pass
+        elif message.embeds and "description" in message.embeds[0] and "title" not in message.embeds[0]:
+            # The winning line
+            self.ready()
+        elif content.startswith("The end!"):
+            self.done.set()
+
+    def on_bot_reaction(self, message):
+        if message.title.startswith("What happens next?") and message.id not in self.voted_polls:
+            self.voted_polls.add(message.id)
+            self.ready()
+            asyncio.create_task(self.vote(message))
+
+    async def write_line(self):
+        await asyncio.sleep(self.think_time())
+        self.act("prompt")
+        self.gateway.user_message(self.channel, self.rng.choice(self.users), stub_sentence(self.rng))
+
+    async def vote(self, poll_message):
+        votes = []
+        for user in self.users:
+            votes.append(asyncio.create_task(self.cast_vote(poll_message, user)))
+        await asyncio.gather(*votes)
+        self.act("poll")
+
+    async def cast_vote(self, poll_message, user):
+        await asyncio.sleep(self.think_time())
+        emoji = self.rng.choice(poll_message.reactions)
+        self.gateway.reaction(poll_message, user, emoji)
+
+    async def run(self):
+        host = self.users[0]
+        self.gateway.user_message(self.channel, host, f"!story {self.lines}")
+        await asyncio.sleep(0.01)
+        for user in self.users:
+            self.gateway.user_message(self.channel, user, "!join")
+        await asyncio.sleep(0.01)
+        self.act("prompt")
+        self.gateway.user_message(self.channel, host, "!start")
+        await self.done.wait()
+
+
+class LoopLagMonitor():
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.lags = []
+        self.peak_rss = 0
+        self.task = None
+
+    async def _run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, time.perf_counter() - start - self.interval))
+            self.peak_rss = max(self.peak_rss, rss_bytes())
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    def stop(self):
+        self.task.cancel()
+
+def rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def percentiles(values: list) -> str:
+    if not values:
+        return "-"
+    values = sorted(values)
+    pick = lambda q: values[min(len(values) - 1, int(q * len(values)))]
+    return f"p50 {pick(0.5) * 1000:7.1f} ms  p95 {pick(0.95) * 1000:7.1f} ms  p99 {pick(0.99) * 1000:7.1f} ms  max {values[-1] * 1000:7.1f} ms"
+
+
+async def simulate(args) -> dict:
+    import bot as story_bot
+    import llm_utils
+    from imageStore import image_store
+
+    rng = random.Random(args.seed)
+    bot = story_bot.bot
+    gateway = SimGateway(bot, args.rest_latency)
+    await bot._async_setup_hook()
+    bot._connection.user = gateway.bot_user
+
+    story_bot.poll_time = args.poll_seconds
+    # As on_ready does, so the first request doesn't import the SDK on the loop
+    await llm_utils.preload_client()
+    if not args.live:
+        options = OpenAIStub(args.llm_latency, args.llm_error_rate, args.seed).client_options()
+        llm_utils.configure_client(**options)
+        # The stub also serves the image URLs it hands out
+        image_store.configure(options["transport"])
+
+    errors = []
+    async def on_command_error(ctx, error):
+        errors.append(error)
+        print(f"Command error in {ctx.command}: {error!r}", file=sys.stderr)
+    bot.add_listener(on_command_error)
+
+    stories = []
+    for c in range(args.channels):
+        channel = SimChannel(gateway, SimGuild())
+        users = [SimUser(f"user{c}-{u}") for u in range(args.users)]
+        stories.append(SimStory(gateway, channel, users, args.lines, args.think, random.Random(rng.random())))
+
+    # Loaded by the first story that renders a frame either way; importing
+    # them now keeps them out of the per-story memory figure
+    import cv2, numpy
+
+    monitor = LoopLagMonitor()
+    baseline_rss = rss_bytes()
+    monitor.start()
+    start = time.perf_counter()
+    try:
+        await asyncio.wait_for(asyncio.gather(*(story.run() for story in stories)), args.timeout)
+    finally:
+        elapsed = time.perf_counter() - start
+        monitor.stop()
+        await story_bot.close_client()
+        await image_store.close()
+        story_bot.graph_renderer.close()
+        story_bot.journal.close()
+        story_bot.story_archive.close()
+
+    latencies = [latency for story in stories for latency in story.latencies]
+    return {
+        "elapsed": elapsed,
+        "latencies": latencies,
+        "lags": monitor.lags,
+        "rssPerStory": (monitor.peak_rss - baseline_rss) / max(args.channels, 1),
+        "restCalls": gateway.rest_calls,
+        "errors": len(errors),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--channels", type=int, default=10, help="Stories running at once, one per channel")
+    parser.add_argument("--users", type=int, default=3, help="Joined users per story")
+    parser.add_argument("--lines", type=int, default=6)
+    parser.add_argument("--poll-seconds", type=float, default=5, help="Replaces the bot's poll_time")
+    parser.add_argument("--think", type=float, default=0.5, help="Mean seconds a user takes to write or vote")
+    parser.add_argument("--rest-latency", type=float, default=0.05, help="Mean seconds per Discord REST call")
+    parser.add_argument("--llm-latency", default="exp:0.3", help="Stub OpenAI latency: fixed:S, uniform:LOW,HIGH, exp:MEAN or lognormal:MEDIAN,SIGMA")
+    parser.add_argument("--llm-error-rate", type=float, default=0.0, help="Fraction of stub OpenAI requests answered with a 429")
+    parser.add_argument("--live", action="store_true", help="Use the configured OpenAI endpoint instead of the local stub")
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workdir", help="Where the bot writes its files (default: a new temp dir)")
+    args = parser.parse_args()
+
+    # Exceptions in event handlers are only reported through logging
+    logging.basicConfig(level=logging.WARNING, format="%(levelname)s %(name)s: %(message)s")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    if args.workdir:
+        os.makedirs(args.workdir, exist_ok=True)
+    os.chdir(args.workdir or tempfile.mkdtemp(prefix="storybot-sim-"))
+    print(f"Simulating {args.channels} channels x {args.users} users, {args.lines} lines each, in {os.getcwd()}")
+
+    result = asyncio.run(simulate(args))
+
+    by_kind = {}
+    for kind, latency in result["latencies"]:
+        by_kind.setdefault(kind, []).append(latency)
+    print(f"finished in {result['elapsed']:.1f} s, {result['restCalls']} REST calls, {result['errors']} command errors")
+    print(f"turn latency    {percentiles([latency for _, latency in result['latencies']])}")
+    for kind, values in sorted(by_kind.items()):
+        print(f"  {kind:<13} {percentiles(values)}")
+    print(f"loop lag        {percentiles(result['lags'])}")
+    print(f"memory          {result['rssPerStory'] / 1024 / 1024:.2f} MB RSS per active story")
+    if result["errors"]:
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
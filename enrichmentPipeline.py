@@ -0,0 +1,79 @@
+import asyncio
+import time
+
+
+class EnrichmentPipeline():
+    """
+    Ordered background queue for one story. Jobs run one at a time in the order
+    they were submitted, so each line is enriched against the state left by the
+    line before it, while the turn loop carries on without waiting.
+    """
+    def __init__(self, story_id):
+        self.story_id = story_id
+        self.queue = asyncio.Queue()
+        self.worker = None
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.total_lag = 0.0
+        self._progress = asyncio.Condition()
+
+    def submit(self, job):
+        """
+        Queue an async callable (no arguments) to run after every job already
+        submitted. Returns the job's sequence number.
+        """
+        self.submitted += 1
+        self.queue.put_nowait((job, time.monotonic()))
+        if self.worker is None or self.worker.done():
+            self.worker = asyncio.create_task(self._run())
+        return self.submitted
+
+    async def wait_for(self, sequence: int):
+        async with self._progress:
+            await self._progress.wait_for(lambda: self.completed >= sequence)
+
+    def barrier(self):
+        """
+        Awaitable that completes once every job submitted so far has run.
+        Jobs submitted afterwards are not waited for.
+        """
+        return self.wait_for(self.submitted)
+
+    async def drain(self):
+        await self.barrier()
+
+    async def _run(self):
+        while True:
+            job, enqueued_at = await self.queue.get()
+            try:
+                await job()
+            except Exception as e:
+                self.failed += 1
+                print(f"Enrichment failed for story {self.story_id}: {e}")
+            finally:
+                lag = time.monotonic() - enqueued_at
+                self.last_lag = lag
+                self.max_lag = max(self.max_lag, lag)
+                self.total_lag += lag
+                self.queue.task_done()
+                async with self._progress:
+                    self.completed += 1
+                    self._progress.notify_all()
+
+    def close(self):
+        if self.worker is not None:
+            self.worker.cancel()
+
+    def metrics(self) -> dict:
+        return {
+            "queueDepth": self.submitted - self.completed,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "lastLagSeconds": round(self.last_lag, 3),
+            "maxLagSeconds": round(self.max_lag, 3),
+            "meanLagSeconds": round(self.total_lag / self.completed, 3) if self.completed else 0.0,
+        }
@@ -0,0 +1,242 @@
+import asyncio
+import copy
+import math
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from storyIndex import StoryIndex
+
+
+def build_graph(characters):
+    """
+    Build the MultiDiGraph of opinions between characters.
+    """
+    import networkx as nx
+
+    # Create a MultiDiGraph (allows multiple edges)
+    G = nx.MultiDiGraph()
+    index = StoryIndex(characters)
+
+    # Add nodes and edges based on opinions
+    for character in characters:
+        if character["opinionsOf"] is None:
+            continue
+        for opinion in character["opinionsOf"]:
+            source = character["name"]
+            target = opinion["characterName"]
+            opinion_text = opinion["opinionText"]
+            trust_level = opinion["trustLevel"]
+            edge_label = f"{opinion_text} - {trust_level}"
+
+            # Add the edge from source to target if not already added
+            if not G.has_edge(source, target):
+                G.add_edge(source, target, label=edge_label)
+
+            # Check if the target has an opinion about the source
+            reverse_opinion = index.opinion(target, source)
+            if reverse_opinion:
+                reverse_opinion_text = reverse_opinion["opinionText"]
+                reverse_trust_level = reverse_opinion["trustLevel"]
+                reverse_edge_label = f"{reverse_opinion_text} - {reverse_trust_level}"
+
+                # Add reverse edge only if not already added
+                if not G.has_edge(target, source):
+                    G.add_edge(target, source, label=reverse_edge_label)
+
+    return G
+
+def compute_layout(G, previous_positions: dict = None) -> dict:
+    """
+    Spring layout for G. With previous_positions (name -> (x, y)) the nodes
+    already placed keep their positions and only new nodes are relaxed around
+    them, which is cheaper and stops the graph jumping between frames.
+    """
+    import networkx as nx
+
+    previous_positions = previous_positions or {}
+    new_nodes = [node for node in G.nodes if node not in previous_positions]
+    if len(new_nodes) == G.number_of_nodes():
+        return nx.spring_layout(G, seed=42)
+
+    pos = {node: previous_positions[node] for node in G.nodes if node in previous_positions}
+    if not new_nodes:
+        return pos
+
+    # Only relax the new nodes, pulled by their already-placed neighbours
+    local_nodes = set(new_nodes)
+    for node in new_nodes:
+        local_nodes.update(nx.all_neighbors(G, node))
+    H = G.subgraph(local_nodes)
+    anchors = [node for node in H.nodes if node in pos]
+    initial = {node: pos[node] for node in anchors}
+    k = 1 / math.sqrt(G.number_of_nodes())  # keep the spacing of the full graph
+    pos.update(nx.spring_layout(H, pos=initial or None, fixed=anchors or None, k=k, seed=42))
+    return pos
+
+#function to create graph
+def create_graph(characters, file_path: str = None, previous_positions: dict = None, frame_dpi: int = None):
+    """
+    Draw the character relationship graph, save it to file_path if one is given
+    and, with frame_dpi, also return the drawn canvas as a BGR numpy frame.
+    Runs inside a renderer worker process, so the plotting libraries are only
+    imported there. Returns (file_path, positions, frame) so the next frame can
+    start from this layout, or (None, previous_positions, None) if there was
+    nothing to draw.
+    """
+    import networkx as nx
+    import matplotlib
+    matplotlib.use("Agg")  # Use a backend that doesn’t require Tkinter
+    import matplotlib.pyplot as plt
+    import numpy as np
+
+    if len(characters)>0:
+        G = build_graph(characters)
+
+        # Initialize the edge_offsets dictionary
+        edge_offsets = {}
+
+        # Draw the graph with a slight offset for separation
+        pos = compute_layout(G, previous_positions)
+
+        # Create a figure and axis for drawing
+        plt.figure(figsize=(10, 6))
+        node_size = 2000
+        # Draw nodes
+        nx.draw_networkx_nodes(G, pos, node_color='skyblue', node_size=node_size)
+        nx.draw_networkx_labels(G, pos, font_size=10, font_weight='bold')
+
+        # Draw the edges and adjust positions for each edge
+        for u, v, key in G.edges(keys=True):
+            edge_data = G[u][v][key]
+            label = edge_data['label']
+
+            # Initialize the offset for this edge if not already set
+            if (u, v) not in edge_offsets:
+                edge_offsets[(u, v)] = 0.9  # Set the initial offset to 3
+
+            # Increment the offset for subsequent edges between the same pair of nodes
+            else:
+                edge_offsets[(u, v)] += 2  # Increase by 2 for each new edge
+
+            # Adjust the position of the edge slightly based on the offset
+            offset = edge_offsets[(u, v)]
+            pos_u = np.array(pos[u])
+            pos_v = np.array(pos[v])
+            
+            edge_vector = pos_v - pos_u
+            edge_vector /= np.linalg.norm(edge_vector) 
+            edge_vector *= offset
+
+            # Draw the edges with the adjusted positions
+            nx.draw_networkx_edges(G, pos, node_size = node_size, edgelist=[(u, v)], width=1, alpha=0.7, edge_color='gray', arrows=True, arrowsize = 25, connectionstyle=f"arc3,rad={0.1 * offset}")
+
+            # Calculate and place the edge labels slightly offset from the edge path
+            midpoint = (np.array(pos_u) + np.array(pos_v)) / 2  
+
+            # Apply different offsets based on the edge direction
+            if (u, v) in G.edges():
+                label_offset = 0.05  
+            else:
+                label_offset = -0.05  
+
+            label_position = midpoint + np.array([label_offset, label_offset])
+
+            # Draw the edge labels (opinion text and trust level) without modifying node positions
+            nx.draw_networkx_edge_labels(G, pos, edge_labels={(u, v, key): label}, font_size=8, verticalalignment="center", horizontalalignment="center", label_pos=0.5,connectionstyle=f"arc3,rad={0.1 * offset}")
+
+
+        # Title and save the plot
+        plt.title("Character Relationships Graph")
+        plt.axis('off')  # Hide the axes for better visualization
+
+        if file_path:
+            plt.savefig(file_path, format="png", dpi=300)
+
+        frame = None
+        if frame_dpi:
+            figure = plt.gcf()
+            figure.set_dpi(frame_dpi)
+            figure.canvas.draw()
+            rgba = np.asarray(figure.canvas.buffer_rgba())
+            frame = np.ascontiguousarray(rgba[:, :, [2, 1, 0]])  # RGBA -> BGR for OpenCV
+
+        plt.close()
+        positions = {node: (float(x), float(y)) for node, (x, y) in pos.items()}
+        return file_path, positions, frame
+
+    return None, previous_positions, None
+
+
+class GraphRenderer():
+    """
+    Renders character graphs in a pool of worker processes so matplotlib never
+    runs on the bot's event loop. At most max_pending renders are in flight at
+    once; further callers wait their turn instead of piling up in the pool.
+    Frames come back as numpy buffers at frame_dpi for the timeline video;
+    the 300 dpi PNGs are only written when save_png is set.
+    """
+    def __init__(self, max_workers: int = None, max_pending: int = None, incremental_layout: bool = True,
+                 save_png: bool = False, frame_dpi: int = 150):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.max_pending = max_pending or self.max_workers * 2
+        self.executor = None
+        self.semaphore = None
+        self.frame_numbers = {}
+        # story_id -> node positions of its last frame, used to warm-start the next layout
+        self.incremental_layout = incremental_layout
+        self.layouts = {}
+        self.save_png = save_png
+        self.frame_dpi = frame_dpi
+
+    def _ensure_started(self):
+        if self.executor is None:
+            # Spawned workers don't inherit the bot's threads or event loop
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+            self.semaphore = asyncio.Semaphore(self.max_pending)
+
+    def next_frame_path(self, story_id) -> str:
+        folder_path = os.sep.join(["Stories", str(story_id), "Graphs"])
+        if story_id not in self.frame_numbers:
+            os.makedirs(folder_path, exist_ok=True)
+            # Continue numbering after any frames left from an earlier run
+            self.frame_numbers[story_id] = len([f for f in os.listdir(folder_path) if f.endswith(".png")])
+        self.frame_numbers[story_id] += 1
+        return os.path.join(folder_path, f"graph_{self.frame_numbers[story_id]}.png")
+
+    async def render(self, story_id, characters: list):
+        """
+        Render a snapshot of the characters as the story's next graph frame.
+        Returns (png path or None, BGR frame or None); both are None if there
+        are no characters yet.
+        """
+        if not characters:
+            return None, None
+        self._ensure_started()
+        snapshot = copy.deepcopy(characters)
+        file_path = self.next_frame_path(story_id) if self.save_png else None
+        async with self.semaphore:
+            loop = asyncio.get_running_loop()
+            previous_positions = self.layouts.get(story_id) if self.incremental_layout else None
+            file_path, positions, frame = await loop.run_in_executor(
+                self.executor, create_graph, snapshot, file_path, previous_positions, self.frame_dpi
+            )
+        if self.incremental_layout and positions:
+            self.layouts[story_id] = positions
+        return file_path, frame
+
+    def forget(self, story_id):
+        self.frame_numbers.pop(story_id, None)
+        self.layouts.pop(story_id, None)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+
+# Shared by every story in the process
+graph_renderer = GraphRenderer()
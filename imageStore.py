@@ -0,0 +1,127 @@
+import asyncio
+import hashlib
+import os
+import uuid
+
+
+IMAGE_SUFFIXES = {
+    "image/png": ".png",
+    "image/jpeg": ".jpg",
+    "image/webp": ".webp",
+    "image/gif": ".gif",
+}
+
+def make_thumbnail(image_path: str, thumbnail_path: str, size: tuple):
+    """
+    Scale the image to fit in size, keeping its aspect ratio. Runs in a
+    worker thread; Pillow is only imported when the first thumbnail is made.
+    """
+    from PIL import Image
+
+    # Written aside and renamed, so a concurrent save of the same image never sees half a file
+    partial_path = f"{thumbnail_path}.{uuid.uuid4().hex}.part"
+    with Image.open(image_path) as image:
+        image.thumbnail(size)
+        image.save(partial_path, "PNG", optimize=True)
+    os.replace(partial_path, thumbnail_path)
+
+
+class ImageStore():
+    """
+    Generated images on disk, named by the sha256 of their content so the
+    same picture is only kept once. Downloads share one pooled HTTP client
+    and are streamed to a temporary file in chunks; the file writes and the
+    thumbnailing run in worker threads so the event loop never waits on them.
+    """
+    def __init__(self, root=os.path.join("Stories", "Images"), thumbnail_size=(256, 256), chunk_size: int = 64 * 1024):
+        self.root = root
+        self.thumbnail_size = thumbnail_size
+        self.chunk_size = chunk_size
+        self.transport = None
+        self.client = None
+        self.downloads = 0
+        self.duplicates = 0
+        self.bytes_downloaded = 0
+
+    def configure(self, transport=None):
+        """
+        Route downloads through another httpx transport, e.g. openaiStub's,
+        which also serves the image URLs it hands out.
+        """
+        self.transport = transport
+        self.client = None
+
+    def _get_client(self):
+        if self.client is None:
+            import httpx
+            self.client = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=20, max_keepalive_connections=5),
+                timeout=httpx.Timeout(60.0, connect=10.0),
+                follow_redirects=True,
+                transport=self.transport,
+            )
+        return self.client
+
+    def paths(self, digest: str, suffix: str = ".png") -> tuple:
+        return (os.path.join(self.root, digest + suffix),
+                os.path.join(self.root, digest + "_thumb.png"))
+
+    async def _download(self, url: str, partial_path: str) -> tuple:
+        """
+        Stream url into partial_path; returns (sha256 hex digest, suffix, size).
+        """
+        hasher = hashlib.sha256()
+        size = 0
+        file = await asyncio.to_thread(open, partial_path, "wb")
+        try:
+            async with self._get_client().stream("GET", url) as response:
+                response.raise_for_status()
+                content_type = response.headers.get("content-type", "").split(";")[0].strip()
+                async for chunk in response.aiter_bytes(self.chunk_size):
+                    hasher.update(chunk)
+                    size += len(chunk)
+                    await asyncio.to_thread(file.write, chunk)
+        finally:
+            await asyncio.to_thread(file.close)
+        return hasher.hexdigest(), IMAGE_SUFFIXES.get(content_type, ".png"), size
+
+    async def save(self, url: str) -> dict:
+        """
+        Download the image at url (before it expires) and thumbnail it.
+        Returns {"sha256", "path", "thumbnail", "bytes"}.
+        """
+        await asyncio.to_thread(os.makedirs, self.root, exist_ok=True)
+        partial_path = os.path.join(self.root, f".{uuid.uuid4().hex}.part")
+        try:
+            digest, suffix, size = await self._download(url, partial_path)
+            image_path, thumbnail_path = self.paths(digest, suffix)
+            self.downloads += 1
+            self.bytes_downloaded += size
+            if os.path.exists(image_path):
+                self.duplicates += 1
+                await asyncio.to_thread(os.remove, partial_path)
+            else:
+                await asyncio.to_thread(os.replace, partial_path, image_path)
+        except BaseException:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+            raise
+
+        if not os.path.exists(thumbnail_path):
+            await asyncio.to_thread(make_thumbnail, image_path, thumbnail_path, self.thumbnail_size)
+        return {"sha256": digest, "path": image_path, "thumbnail": thumbnail_path, "bytes": size}
+
+    def stats(self) -> dict:
+        return {
+            "downloads": self.downloads,
+            "duplicates": self.duplicates,
+            "bytesDownloaded": self.bytes_downloaded,
+        }
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+
+image_store = ImageStore()
@@ -1,8 +1,12 @@
-import cv2
 import os
 import glob
 
+# cv2 is imported inside the functions that use it, so importing this module
+# (and everything that imports it) doesn't pay for OpenCV until a video is made
+
 def images_to_video(image_folder, output_video, frame_rate=1, resolution=None):
+    import cv2
+
     image_files = sorted(glob.glob(os.path.join(image_folder, "*.*")), key=os.path.getmtime)
     
     if not image_files:
@@ -34,9 +38,81 @@ def images_to_video(image_folder, output_video, frame_rate=1, resolution=None):
     out.release()
     print(f"Video saved as {output_video}")
 
-image_folder = "path/to/images"  
-output_video = "output_video.mp4"
-frame_rate = 30 
-resolution = None #(1280, 720)  
+class VideoFrameSink():
+    """
+    Keeps a cv2.VideoWriter open for one video and appends frames (BGR numpy
+    arrays) as they are rendered, so the video is complete as soon as close()
+    returns. The frame size is fixed by the first frame unless a resolution is
+    given; later frames are resized to match.
+    """
+    def __init__(self, output_video, frame_rate=1, resolution=None):
+        self.output_video = output_video
+        self.frame_rate = frame_rate
+        self.resolution = resolution
+        self.writer = None
+        self.frame_count = 0
+
+    def append(self, frame):
+        import cv2
+
+        if self.writer is None:
+            if self.resolution:
+                width, height = self.resolution
+            else:
+                height, width = frame.shape[:2]
+            self.resolution = (width, height)
+            os.makedirs(os.path.dirname(self.output_video) or ".", exist_ok=True)
+            fourcc = cv2.VideoWriter_fourcc(*'mp4v')  # MP4 format
+            self.writer = cv2.VideoWriter(self.output_video, fourcc, self.frame_rate, self.resolution)
+
+        if (frame.shape[1], frame.shape[0]) != self.resolution:
+            frame = cv2.resize(frame, self.resolution)
+
+        self.writer.write(frame)
+        self.frame_count += 1
+
+    def close(self):
+        """
+        Finish the video. Returns its path, or None if no frames were written.
+        """
+        if self.writer is None:
+            return None
+        self.writer.release()
+        self.writer = None
+        print(f"Video saved as {self.output_video}")
+        return self.output_video
+
+def join_videos(segments, output_video, frame_rate=1):
+    """
+    Concatenate the frames of segments, in order, into output_video. A
+    segment that can't be read (e.g. one left unfinished by a crash) is
+    skipped. Returns output_video, or None if no frames were read.
+    """
+    import cv2
+
+    root, ext = os.path.splitext(output_video)
+    sink = VideoFrameSink(f"{root}.joining{ext}", frame_rate)
+    for segment in segments:
+        capture = cv2.VideoCapture(segment)
+        if not capture.isOpened():
+            print(f"Skipping unreadable video: {segment}")
+            continue
+        while True:
+            ok, frame = capture.read()
+            if not ok:
+                break
+            sink.append(frame)
+        capture.release()
+
+    if sink.close() is None:
+        return None
+    os.replace(sink.output_video, output_video)
+    return output_video
+
+if __name__ == "__main__":
+    image_folder = "path/to/images"  
+    output_video = "output_video.mp4"
+    frame_rate = 30 
+    resolution = None #(1280, 720)  
 
-images_to_video(image_folder, output_video, frame_rate, resolution)
+    images_to_video(image_folder, output_video, frame_rate, resolution)
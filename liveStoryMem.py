@@ -1,20 +1,25 @@
+import asyncio
+import copy
 from datetime import datetime
 from llm_utils import *
 from imgToVid import *
-import requests
-
-import networkx as nx
-import matplotlib
-matplotlib.use("Agg")  # Use a backend that doesn’t require Tkinter
-import matplotlib.pyplot as plt
-
-import numpy as np
+from enrichmentPipeline import EnrichmentPipeline
+from storyJournal import StoryJournal
+from storyArchive import story_archive
+from graphRenderer import graph_renderer
+from imageStore import image_store
+from storyIndex import index_for, forget_index
+from storyDigest import compact_characters, compact_settings, fit_entries, fit_text
+from llmMetrics import story_scope
+from taskGraph import TaskGraph
+
+import glob
 import os
 
 # A global or module-level dictionary for active stories (story_id -> story_data)
 active_stories = {}
 
-def create_story(story_id: str, starter_line: str, personality: str, user_id: str): # all this info is from discord / we create it
+async def create_story(story_id: str, starter_line: str, personality: str, user_id: str): # all this info is from discord / we create it
     """
     1) Initialize the in-memory JSON structure
     2) Use LLM to fill in initial metadata (title, genre, tone, style, theme keywords)
@@ -50,19 +55,32 @@ def create_story(story_id: str, starter_line: str, personality: str, user_id: st
         }
     }
 
-    initial_meta = generate_initial_story_metadata(starter_line)
-    set_story_metadata(story_data, initial_meta)
-
+    # Metadata and summary only depend on the starter line, so request both at once
     story_text = starter_line
-    story_summary = generate_story_summary(story_text)
+    with story_scope(story_id):
+        initial_meta, story_summary = await asyncio.gather(
+            generate_initial_story_metadata(starter_line),
+            generate_story_summary(story_text),
+        )
+    set_story_metadata(story_data, initial_meta)
     update_story_summary(story_data, story_summary)
 
     active_stories[story_id] = story_data
+    journal_record(story_id, {"op": "create", "story": story_data})
 
     return story_data
 
 
-def generate_initial_story_metadata(starter_line: str) -> dict: 
+# Structured-output schema for the title/genre/tone/style/themeKeywords prompts
+METADATA_FORMAT = json_schema_format("story_metadata", {
+    "title": {"type": "string"},
+    "genre": {"type": "string"},
+    "tone": {"type": "string"},
+    "style": {"type": "string"},
+    "themeKeywords": {"type": "array", "items": {"type": "string"}},
+})
+
+async def generate_initial_story_metadata(starter_line: str) -> dict: 
     """
     Use the LLM to propose a title, genre, tone, style, and theme keywords 
     based on the given starter line.
@@ -97,12 +115,9 @@ def generate_initial_story_metadata(starter_line: str) -> dict:
         "themeKeywords": ["keyword1", "keyword2", ...]
       }}
     """
-    raw_response = call_llm_api(prompt)
-    data = parse_llm_json_response(raw_response)
+    return await call_llm_json(prompt, "initial_metadata", METADATA_FORMAT)
 
-    return data
-
-def add_new_line_and_update_by_id(story_id: str, new_line: str, added_by: str): # New line is llmed or discord (need logic), we manage story id, added by is from discord
+async def add_new_line_and_update_by_id(story_id: str, new_line: str, added_by: str): # New line is llmed or discord (need logic), we manage story id, added by is from discord
     """
     1) Retrieve the correct story from 'active_stories' by ID
     2) Call 'add_new_line_and_update' to handle LLM-based updates
@@ -113,24 +128,21 @@ def add_new_line_and_update_by_id(story_id: str, new_line: str, added_by: str):
     if not story_data:
         raise ValueError(f"No active story found with ID {story_id}")
 
-    updated_story = add_new_line_and_update(story_data, new_line, added_by)
+    updated_story = await add_new_line_and_update(story_data, new_line, added_by)
 
     active_stories[story_id] = updated_story
     return updated_story
 
 def parse_llm_json_response(llm_response_text: str) -> dict:
     """
-    Attempt to parse the LLM's response as JSON. 
-    If parsing fails, return an empty dict or handle gracefully.
+    Attempt to parse the LLM's response as JSON, repairing code fences and
+    surrounding prose. If parsing fails, return an empty dict.
     """
-    import json
-
     try:
-        data = json.loads(llm_response_text)
-        return data
-    except json.JSONDecodeError:
-        # Optionally handle or log the error
+        data, _ = parse_llm_json(llm_response_text)
+    except ValueError:
         return {}
+    return data if isinstance(data, dict) else {}
 
 
 def set_story_metadata(story_data: dict, extracted_data: dict):
@@ -147,22 +159,56 @@ def set_story_metadata(story_data: dict, extracted_data: dict):
 
 
 
-def generate_story_summary(full_story_text: str) -> str:
-    """
-    Ask the LLM for a short summary of the chapter text (1-2 sentences).
-    Return just the text string.
-    """
-    prompt = f"""
+def build_story_summary_prompt(full_story_text: str) -> str:
+    return f"""
     The following text is the content of the story:
     "{full_story_text}"
 
     Please provide a concise 1-2 sentence summary of this chapter.
     Return just the summary text (no JSON needed).
     """
-    raw_response = call_llm_api(prompt)
+
+async def generate_story_summary(full_story_text: str) -> str:
+    """
+    Ask the LLM for a short summary of the chapter text (1-2 sentences).
+    Return just the text string.
+    """
+    prompt = build_story_summary_prompt(full_story_text)
+    raw_response = await call_llm_api(prompt, call_site="story_summary")
   
     return raw_response
 
+# Caps that keep the rolling summary prompt the same size however long the story gets
+SUMMARY_CHAR_LIMIT = 600
+ROLLING_LINE_CHAR_LIMIT = 400
+
+def build_rolling_summary_prompt(previous_summary: str, new_lines: list) -> str:
+    previous_summary = previous_summary[-SUMMARY_CHAR_LIMIT:]
+    latest = " ".join(line[-ROLLING_LINE_CHAR_LIMIT:] for line in new_lines[-2:])
+    return f"""
+    The summary of the story so far is:
+    "{previous_summary}"
+
+    The story continues with: "{latest}"
+
+    Please rewrite the summary so it also covers the new text, keeping it to a concise 1-2 sentences.
+    Return just the summary text (no JSON needed).
+    """
+
+async def update_rolling_summary(previous_summary: str, new_lines: list) -> str:
+    """
+    Fold only the newest line(s) into the previous summary instead of
+    re-reading the whole story, so each call costs the same number of tokens.
+    Return just the text string.
+    """
+    if not previous_summary:
+        return await generate_story_summary(" ".join(new_lines))
+
+    prompt = build_rolling_summary_prompt(previous_summary, new_lines)
+    raw_response = await call_llm_api(prompt, call_site="rolling_summary")
+
+    return raw_response
+
 def update_story_summary(story_data: dict, new_summary: str):
     """
     Set or replace the storySummary.
@@ -170,122 +216,11 @@ def update_story_summary(story_data: dict, new_summary: str):
     story_data["storySummary"] = new_summary
     story_data["storyMetadata"]["lastUpdated"] = datetime.utcnow().isoformat()
 
-def save_graph(story_id):
-    folder_path = os.sep.join(["Stories", str(story_id), "Graphs"])
-    os.makedirs(folder_path, exist_ok=True)
-    print(folder_path)
-
-    existing_files = [f for f in os.listdir(folder_path) if f.endswith(".png")]
-
-    next_number = len(existing_files) + 1
-    file_name = f"graph_{next_number}.png"
-    file_path = os.path.join(folder_path, file_name)
-
-    plt.savefig(file_path, format="png", dpi=300)
-    #print(f"Graph saved as: {file_path}")
-
-#function to create graph
-def create_graph(characters, story_id):
-    print(len(characters))
-    if len(characters)>0:
-        # Create a MultiDiGraph (allows multiple edges)
-        G = nx.MultiDiGraph()
-
-        # Initialize the edge_offsets dictionary
-        edge_offsets = {}
-
-        # Add nodes and edges based on opinions
-        for character in characters:
-            if character["opinionsOf"] is None:
-                continue
-            for opinion in character["opinionsOf"]:
-                source = character["name"]
-                target = opinion["characterName"]
-                opinion_text = opinion["opinionText"]
-                trust_level = opinion["trustLevel"]
-                edge_label = f"{opinion_text} - {trust_level}"
-
-                # Add the edge from source to target if not already added
-                if not G.has_edge(source, target):
-                    G.add_edge(source, target, label=edge_label)
-
-                # Check if the target has an opinion about the source
-                reverse_opinion = next((op for op in characters if op["name"] == target), None)
-                if reverse_opinion:
-                    reverse_opinion = next((o for o in reverse_opinion["opinionsOf"] if o["characterName"] == source), None)
-                    if reverse_opinion:
-                        reverse_opinion_text = reverse_opinion["opinionText"]
-                        reverse_trust_level = reverse_opinion["trustLevel"]
-                        reverse_edge_label = f"{reverse_opinion_text} - {reverse_trust_level}"
-
-                        # Add reverse edge only if not already added
-                        if not G.has_edge(target, source):
-                            G.add_edge(target, source, label=reverse_edge_label)
-
-        # Draw the graph with a slight offset for separation
-        pos = nx.spring_layout(G, seed=42) 
-
-        # Create a figure and axis for drawing
-        plt.figure(figsize=(10, 6))
-        node_size = 2000
-        # Draw nodes
-        nx.draw_networkx_nodes(G, pos, node_color='skyblue', node_size=node_size)
-        nx.draw_networkx_labels(G, pos, font_size=10, font_weight='bold')
-
-        # Draw the edges and adjust positions for each edge
-        for u, v, key in G.edges(keys=True):
-            edge_data = G[u][v][key]
-            label = edge_data['label']
-
-            # Initialize the offset for this edge if not already set
-            if (u, v) not in edge_offsets:
-                edge_offsets[(u, v)] = 0.9  # Set the initial offset to 3
-
-            # Increment the offset for subsequent edges between the same pair of nodes
-            else:
-                edge_offsets[(u, v)] += 2  # Increase by 2 for each new edge
-
-            # Adjust the position of the edge slightly based on the offset
-            offset = edge_offsets[(u, v)]
-            pos_u = np.array(pos[u])
-            pos_v = np.array(pos[v])
-            
-            edge_vector = pos_v - pos_u
-            edge_vector /= np.linalg.norm(edge_vector) 
-            edge_vector *= offset
-
-            # Draw the edges with the adjusted positions
-            nx.draw_networkx_edges(G, pos, node_size = node_size, edgelist=[(u, v)], width=1, alpha=0.7, edge_color='gray', arrows=True, arrowsize = 25, connectionstyle=f"arc3,rad={0.1 * offset}")
-
-            # Calculate and place the edge labels slightly offset from the edge path
-            midpoint = (np.array(pos_u) + np.array(pos_v)) / 2  
-
-            # Apply different offsets based on the edge direction
-            if (u, v) in G.edges():
-                label_offset = 0.05  
-            else:
-                label_offset = -0.05  
-
-            label_position = midpoint + np.array([label_offset, label_offset])
-
-            # Draw the edge labels (opinion text and trust level) without modifying node positions
-            nx.draw_networkx_edge_labels(G, pos, edge_labels={(u, v, key): label}, font_size=8, verticalalignment="center", horizontalalignment="center", label_pos=0.5,connectionstyle=f"arc3,rad={0.1 * offset}")
-
-
-        # Title and show the plot
-        plt.title("Character Relationships Graph")
-        plt.axis('off')  # Hide the axes for better visualization
-
-        save_graph(story_id)
-
-
-def add_new_line_and_update(story_data: dict, new_line: str, added_by: str):
+def append_line(story_data: dict, new_line: str, added_by: str) -> dict:
     """
-    1) Add the new line to story_data["lines"]
-    2) Call LLM to discover new characters/settings
-    3) Update the entire story summary
+    Add the new line to story_data["lines"] and the overall text.
+    Return the new line entry.
     """
-    # 1. Append new line
     line_id = f"line-{len(story_data['lines'])+1:03d}"
     line_entry = {
         "lineId": line_id,
@@ -293,18 +228,42 @@ def add_new_line_and_update(story_data: dict, new_line: str, added_by: str):
         "addedBy": added_by,
         "timestamp": datetime.utcnow().isoformat()
     }
+    append_line_entry(story_data, line_entry)
+
+    return line_entry
+
+def append_line_entry(story_data: dict, line_entry: dict):
     story_data["lines"].append(line_entry)
 
     # Also update the overall text
+    new_line = line_entry["text"]
     story_data["currentStoryText"] += " " + new_line + ("." if new_line[-1] != "." else "")
 
-    # 2. LLM prompt to extract new characters/settings from the latest line
-    prompt_extract = f"""
-    The story so far is:
-    {story_data['currentStoryText']}
+# How much of the story the enrichment prompt sees besides the summary
+ENRICHMENT_RECENT_LINES = 3
+ENRICHMENT_KNOWN_NAMES = 50
+
+def build_enrichment_prompt(story_data: dict, new_line: str, preceding_lines: int = None) -> str:
+    # preceding_lines is how many lines came before new_line; by default it is the last line
+    if preceding_lines is None:
+        preceding_lines = len(story_data["lines"]) - 1
+    summary = story_data.get("storySummary", "")[-SUMMARY_CHAR_LIMIT:]
+    recent_lines = [line["text"][-ROLLING_LINE_CHAR_LIMIT:] for line in story_data["lines"][:preceding_lines][-ENRICHMENT_RECENT_LINES:]]
+    known_characters = [c["name"] for c in story_data.get("characters", [])][-ENRICHMENT_KNOWN_NAMES:]
+    known_settings = [s["locationName"] for s in story_data.get("settings", [])][-ENRICHMENT_KNOWN_NAMES:]
+
+    return f"""
+    The summary of the story so far is:
+    "{summary}"
+
+    The most recent lines were:
+    {" ".join(recent_lines)}
 
     The latest line is: "{new_line}"
 
+    Characters already known: {", ".join(known_characters) or "none"}
+    Settings already known: {", ".join(known_settings) or "none"}
+
     If any new characters have been introduced or revealed with more details, 
     please include them in JSON under the key "newCharacters". 
     Each character should have:
@@ -328,7 +287,10 @@ def add_new_line_and_update(story_data: dict, new_line: str, added_by: str):
     - "description"
     - "keyDetails" (an array of strings)
 
-    Return valid JSON with these exact top-level keys if relevant:
+    Finally, rewrite the summary so it also covers the latest line, keeping it to
+    a concise 1-2 sentences, under the key "storySummary".
+
+    Return valid JSON with these exact top-level keys:
 
     "newCharacters": [
     {{
@@ -354,24 +316,256 @@ def add_new_line_and_update(story_data: dict, new_line: str, added_by: str):
         "keyDetails": []
     }},
     ...
-    ]
+    ],
+    "storySummary": "..."
+
+    Use empty lists for "newCharacters" or "newSettings" when nothing new appears.
+    """
+
+ENRICHMENT_FORMAT = json_schema_format("enrichment", {
+    "newCharacters": {"type": "array", "items": strict_object({
+        "name": {"type": "string"},
+        "description": {"type": "string"},
+        "status": {"type": "string"},
+        "traits": {"type": "array", "items": {"type": "string"}},
+        "opinionsOf": {"type": "array", "items": strict_object({
+            "characterName": {"type": "string"},
+            "opinionText": {"type": "string"},
+            "trustLevel": {"type": "integer"},
+        })},
+    })},
+    "newSettings": {"type": "array", "items": strict_object({
+        "locationName": {"type": "string"},
+        "description": {"type": "string"},
+        "keyDetails": {"type": "array", "items": {"type": "string"}},
+    })},
+    "storySummary": {"type": "string"},
+})
+
+async def enrich_new_line(story_data: dict, new_line: str, preceding_lines: int = None) -> dict:
+    """
+    One LLM call that returns the new characters, new settings and the
+    updated summary for a line. Does not modify story_data.
+    """
+    prompt = build_enrichment_prompt(story_data, new_line, preceding_lines)
+    with story_scope(story_data.get("story_Id")):
+        return await call_llm_json(prompt, "enrichment", ENRICHMENT_FORMAT)
+
+# story_id -> VideoFrameSink that the story's graph frames are streamed into
+timeline_sinks = {}
+
+def timeline_path(story_id) -> str:
+    return f"Stories/{story_id}/ConnectionsTimeline.mp4"
 
-    Omit any sections (or keys) that are not applicable.
+def timeline_segments(story_id) -> list:
     """
+    The parts of the story's timeline written before a restart, in order.
+    """
+    segments = glob.glob(f"Stories/{story_id}/ConnectionsTimeline.part*.mp4")
+    return sorted(segments, key=lambda path: int(path.rsplit(".part", 1)[1][:-len(".mp4")]))
+
+def open_timeline(story_id) -> VideoFrameSink:
+    """
+    Start streaming frames into the story's timeline. A timeline already on
+    disk was started before a restart; it is kept as a segment and this
+    process writes the next one, so close_timeline can join them.
+    """
+    path = timeline_path(story_id)
+    segments = timeline_segments(story_id)
+    if os.path.exists(path):
+        segments.append(f"Stories/{story_id}/ConnectionsTimeline.part{len(segments)}.mp4")
+        os.replace(path, segments[-1])
+    if segments:
+        path = f"Stories/{story_id}/ConnectionsTimeline.part{len(segments)}.mp4"
+    return VideoFrameSink(path)
+
+def close_timeline(story_id):
+    """
+    Finish the story's timeline video, joining any segments from before a
+    restart. Returns its path, or None if no frames were streamed.
+    """
+    sink = timeline_sinks.pop(story_id, None)
+    closed = sink.close() if sink is not None else None
+    segments = timeline_segments(story_id)
+    if not segments:
+        return closed
+    joined = join_videos(segments, timeline_path(story_id))
+    for segment in segments:
+        os.remove(segment)
+    return joined
+
+async def render_story_graph(story_data: dict):
+    """
+    Render the story's character graph in the renderer's worker processes and
+    append it to the story's timeline video. Returns the PNG path if PNGs are
+    being saved (or None).
+    """
+    story_id = story_data["story_Id"]
+    file_path, frame = await graph_renderer.render(story_id, story_data.get("characters", []))
+    if frame is not None:
+        sink = timeline_sinks.get(story_id)
+        if sink is None:
+            sink = timeline_sinks.setdefault(story_id, await asyncio.to_thread(open_timeline, story_id))
+        await asyncio.to_thread(sink.append, frame)
+    return file_path
+
+def apply_enrichment(story_data: dict, enrichment: dict):
+    """
+    Merge the result of enrich_new_line into story_data. A missing summary
+    leaves the previous one in place.
+    """
+    add_characters(story_data, enrichment.get("newCharacters") or [])
+    add_settings(story_data, enrichment.get("newSettings") or [])
 
-    raw_response = call_llm_api(prompt_extract)
-    extracted_data = parse_llm_json_response(raw_response)
+    new_summary = enrichment.get("storySummary")
+    if new_summary:
+        update_story_summary(story_data, new_summary)
 
-    # Update characters, settings
-    add_characters(story_data, extracted_data.get("newCharacters", []))
-    add_settings(story_data, extracted_data.get("newSettings", []))
+async def add_new_line_and_update(story_data: dict, new_line: str, added_by: str):
+    """
+    1) Add the new line to story_data["lines"]
+    2) Call LLM once to discover new characters/settings and update the summary
+    3) Merge the results into story_data and render the graph frame
+    """
+    line_entry = append_line(story_data, new_line, added_by)
+    journal_line(story_data, line_entry)
 
-    # 3. Update the summary for the entire story
-    new_summary = generate_story_summary(story_data["currentStoryText"])
-    update_story_summary(story_data, new_summary)
+    enrichment = await enrich_new_line(story_data, new_line)
+    apply_enrichment(story_data, enrichment)
+    journal_enrichment(story_data, line_entry, enrichment)
+    await render_story_graph(story_data)
 
     return story_data
 
+# story_id -> EnrichmentPipeline for every story with background enrichment
+enrichment_pipelines = {}
+
+def get_enrichment_pipeline(story_id) -> EnrichmentPipeline:
+    pipeline = enrichment_pipelines.get(story_id)
+    if pipeline is None:
+        pipeline = EnrichmentPipeline(story_id)
+        enrichment_pipelines[story_id] = pipeline
+    return pipeline
+
+async def wait_for_enrichment(story_id):
+    """
+    Barrier: returns once every line queued so far for the story is enriched.
+    """
+    pipeline = enrichment_pipelines.get(story_id)
+    if pipeline is not None:
+        await pipeline.drain()
+
+def close_enrichment_pipeline(story_id):
+    pipeline = enrichment_pipelines.pop(story_id, None)
+    if pipeline is not None:
+        pipeline.close()
+
+def enrichment_metrics() -> dict:
+    return {story_id: pipeline.metrics() for story_id, pipeline in enrichment_pipelines.items()}
+
+def queue_new_line_by_id(story_id, new_line: str, added_by: str, speculation=None, winner: int = None) -> dict:
+    """
+    1) Append the line to the story straight away
+    2) Queue its enrichment on the story's pipeline, reusing the speculative
+       result for 'winner' if one is given
+    3) Return the line entry without waiting for the LLM
+    """
+    story_data = active_stories.get(story_id)
+    if not story_data:
+        raise ValueError(f"No active story found with ID {story_id}")
+
+    line_entry = append_line(story_data, new_line, added_by)
+    journal_line(story_data, line_entry)
+    queue_enrichment(story_id, line_entry, len(story_data["lines"]) - 1, speculation, winner)
+    return line_entry
+
+def queue_enrichment(story_id, line_entry: dict, preceding_lines: int, speculation=None, winner: int = None):
+    story_data = active_stories[story_id]
+    new_line = line_entry["text"]
+
+    async def enrich():
+        enrichment = None
+        if speculation is not None:
+            try:
+                enrichment = await speculation.take(winner)
+            except Exception as e:
+                print(f"Speculative enrichment failed, retrying: {e}")
+        if enrichment is None:
+            enrichment = await enrich_new_line(story_data, new_line, preceding_lines)
+        apply_enrichment(story_data, enrichment)
+        journal_enrichment(story_data, line_entry, enrichment)
+        await render_story_graph(story_data)
+
+    get_enrichment_pipeline(story_id).submit(enrich)
+
+
+class SpeculativeEnrichment():
+    """
+    Enrichment for every poll option, started while the vote is still running.
+    Each option is enriched against its own forked copy of the story, taken
+    once the lines queued before the poll have been enriched, so the live
+    story is untouched until take() picks the winner. The fork only keeps
+    the lines there were when the poll opened: by the time it is taken the
+    winner (and maybe the next line) can already be in the live story.
+    """
+    def __init__(self, story_id, candidates: list, added_by: str, ready=None):
+        self.story_id = story_id
+        story_data = active_stories[story_id]
+        self.line_count = len(story_data["lines"])
+        self.text_length = len(story_data["currentStoryText"])
+        self.candidates = []
+        self.added_by = added_by
+        self.ready = asyncio.ensure_future(ready) if ready is not None else None
+        self.tasks = []
+        for candidate in candidates:
+            self.add(candidate)
+
+    def add(self, candidate: str):
+        """
+        Start enriching another option, e.g. as soon as it is streamed in.
+        """
+        self.candidates.append(candidate)
+        task = asyncio.create_task(self._enrich_fork(candidate))
+        # Losing options are never awaited, so retrieve their errors here
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        self.tasks.append(task)
+
+    async def _enrich_fork(self, candidate: str) -> dict:
+        if self.ready is not None:
+            await asyncio.shield(self.ready)
+        story_data = active_stories.get(self.story_id)
+        if not story_data:
+            raise ValueError(f"No active story found with ID {self.story_id}")
+        lines = story_data["lines"]
+        story_data["lines"] = lines[:self.line_count]
+        try:
+            fork = copy.deepcopy(story_data)
+        finally:
+            story_data["lines"] = lines
+        fork["currentStoryText"] = fork["currentStoryText"][:self.text_length]
+        append_line(fork, candidate, self.added_by)
+        return await enrich_new_line(fork, candidate)
+
+    def discard(self):
+        for task in self.tasks:
+            task.cancel()
+
+    async def take(self, winner: int) -> dict:
+        """
+        Cancel the losing options and return the winner's enrichment.
+        """
+        for i, task in enumerate(self.tasks):
+            if i != winner:
+                task.cancel()
+        return await self.tasks[winner]
+
+def speculate_enrichment(story_id, candidates: list, added_by: str) -> SpeculativeEnrichment:
+    # candidates may be empty and filled in later with SpeculativeEnrichment.add
+    if story_id not in active_stories:
+        raise ValueError(f"No active story found with ID {story_id}")
+    ready = get_enrichment_pipeline(story_id).barrier()
+    return SpeculativeEnrichment(story_id, candidates, added_by, ready)
+
 
 def add_characters(story_data: dict, characters: list):
     """
@@ -382,16 +576,11 @@ def add_characters(story_data: dict, characters: list):
     ]
     Append them to story_data["characters"] if they're not already present.
     """
-    existing_characters = story_data.get("characters", [])
+    index = index_for(story_data)
 
     for new_char in characters:
         # Check for duplicates by name (or handle it differently if multiple chars can share name)
-        if not any(c["name"] == new_char["name"] for c in existing_characters):
-            existing_characters.append(new_char)
-
-    story_data["characters"] = existing_characters
-    story_id = story_data["story_Id"]
-    create_graph(existing_characters, story_id)
+        index.add_character(new_char)
 
     story_data["storyMetadata"]["lastUpdated"] = datetime.utcnow().isoformat()
 
@@ -409,26 +598,127 @@ def add_settings(story_data: dict, settings: list):
     ]
     Append them if not present.
     """
-    existing_settings = story_data.get("settings", [])
+    index = index_for(story_data)
 
     for new_set in settings:
-        if not any(s["locationName"] == new_set["locationName"] for s in existing_settings):
-            existing_settings.append(new_set)
-
-    story_data["settings"] = existing_settings
+        index.add_setting(new_set)
 
     story_data["storyMetadata"]["lastUpdated"] = datetime.utcnow().isoformat()
 
 
+###########################################################
+######################## Journal ##########################
+###########################################################
+
+journal = StoryJournal()
+# story_id -> journal state that isn't part of story_data:
+# the lineIds of the lines after the first that have been enriched, and the
+# bot's session info
+journal_state = {}
+
+def new_journal_state() -> dict:
+    return {"enrichedLineIds": [], "session": None}
+
+def journal_record(story_id, record: dict):
+    state = journal_state.setdefault(story_id, new_journal_state())
+    journal.append(story_id, record, lambda: {"story": active_stories[story_id], **state})
+
+def journal_line(story_data: dict, line_entry: dict):
+    story_id = story_data["story_Id"]
+    if active_stories.get(story_id) is story_data:
+        journal_record(story_id, {"op": "line", "line": line_entry})
+
+def journal_enrichment(story_data: dict, line_entry: dict, enrichment: dict):
+    story_id = story_data["story_Id"]
+    if active_stories.get(story_id) is story_data:
+        journal_state.setdefault(story_id, new_journal_state())["enrichedLineIds"].append(line_entry["lineId"])
+        journal_record(story_id, {"op": "enrich", "lineId": line_entry["lineId"], "enrichment": enrichment})
+
+def journal_session(story_id, session_info: dict):
+    """
+    Record what the bot needs to resume the story's session after a restart.
+    """
+    journal_state.setdefault(story_id, new_journal_state())["session"] = session_info
+    journal_record(story_id, {"op": "session", "session": session_info})
+
+def restore_active_stories() -> dict:
+    """
+    Rebuild active_stories from the journal after a restart and queue
+    enrichment again for lines that were appended but not yet enriched.
+    Call from the running event loop. Returns story_id -> session info (or
+    None) for every restored story.
+    """
+    restored = {}
+    for story_id in journal.story_ids():
+        snapshot, records = journal.load(story_id)
+        story_data = snapshot["story"] if snapshot else None
+        state = new_journal_state()
+        if snapshot:
+            state["session"] = snapshot.get("session")
+            state["enrichedLineIds"] = list(snapshot.get("enrichedLineIds", []))
+            if "enrichedLines" in snapshot:
+                # Snapshots from before ids were kept counted the enriched lines
+                count = snapshot["enrichedLines"]
+                state["enrichedLineIds"] = [line["lineId"] for line in story_data["lines"][1:1 + count]]
+
+        for record in records:
+            op = record["op"]
+            if op == "create":
+                story_data = record["story"]
+            elif op == "line":
+                append_line_entry(story_data, record["line"])
+            elif op == "enrich":
+                apply_enrichment(story_data, record["enrichment"])
+                state["enrichedLineIds"].append(record["lineId"])
+            elif op == "session":
+                state["session"] = record["session"]
+
+        if story_data is None:
+            journal.discard(story_id)
+            continue
+
+        active_stories[story_id] = story_data
+        journal_state[story_id] = state
+        # A failed enrichment doesn't stop later ones, so the gaps can be anywhere
+        enriched = set(state["enrichedLineIds"])
+        for preceding_lines, line_entry in enumerate(story_data["lines"][1:], start=1):
+            if line_entry["lineId"] not in enriched:
+                queue_enrichment(story_id, line_entry, preceding_lines)
+        restored[story_id] = state["session"]
+
+    return restored
+
+def end_story(story_id):
+    """
+    Drop everything held for a story that the bot has finished with,
+    including its journal.
+    """
+    close_enrichment_pipeline(story_id)
+    close_timeline(story_id)
+    active_stories.pop(story_id, None)
+    journal_state.pop(story_id, None)
+    journal.discard(story_id)
+    graph_renderer.forget(story_id)
+    forget_index(story_id)
+
+
 def get_story(story_id: str):
     return active_stories.get(story_id)
 
-def finalize_story(story_id: str) -> dict:
+# story_id -> seconds each finalisation step took, for the most recent stories
+finalisation_timings = {}
+MAX_FINALISATION_TIMINGS = 50
 
-    story_data = active_stories[story_id]
+def record_finalisation(story_id, graph: TaskGraph):
+    finalisation_timings.pop(story_id, None)
+    finalisation_timings[story_id] = dict(graph.timings)
+    while len(finalisation_timings) > MAX_FINALISATION_TIMINGS:
+        finalisation_timings.pop(next(iter(finalisation_timings)))
+    print(f"Finalised story {story_id}: {graph.report()}")
 
-    prompt = f"""
-    The completed story is: "{story_data["currentStoryText"]}"
+def build_final_metadata_prompt(full_story_text: str) -> str:
+    return f"""
+    The completed story is: "{full_story_text}"
 
     Please propose:
     1) A suitable title (short, up to 5 words)
@@ -449,26 +739,71 @@ def finalize_story(story_id: str) -> dict:
         "themeKeywords": ["keyword1", "keyword2", ...]
       }}
     """
-    raw_response = call_llm_api(prompt)
-    data = parse_llm_json_response(raw_response)
-
-    set_story_metadata(story_data, data)
-
-    story_summary = generate_story_summary(story_data["currentStoryText"])
-    update_story_summary(story_data, story_summary)
-
-    story_data = active_stories.pop(story_id, None)
-
-    story_id = story_data["story_Id"]
-
-    ##final_image_url = generate_final_image(build_dalle_prompt(story_data)) ## Comment to save money
-    ##imgName = story_data["title"]## Comment to save money
-    ##story_id = story_data["story_Id"]
-    ##save_image(final_image_url, folder=f"Stories/{story_id}" filename=f"{imgName}.png") ## Comment to save money
 
-    save_story_data(story_data, folder=f"Stories/{story_id}")
-
-    images_to_video(f"Stories/{story_id}/Graphs", f"Stories/{story_id}/ConnectionsTimeline.mp4")
+def add_finalisation_steps(graph: TaskGraph, story_id, after=(), save_after=(), with_image: bool = False):
+    """
+    Add the steps that finish a story to graph: once the steps in after are
+    done, regenerate the metadata from the whole story and wait for its
+    enrichment, then regenerate the summary and finish its timeline video;
+    save it once those and the steps in save_after are done. with_image
+    also generates and stores its final illustration before the save.
+    """
+    story_data = active_stories[story_id]
+    folder = f"Stories/{story_data['story_Id']}"
+
+    async def enrichment(*_):
+        await wait_for_enrichment(story_id)
+        close_enrichment_pipeline(story_id)
+
+    async def metadata(*_):
+        prompt = build_final_metadata_prompt(story_data["currentStoryText"])
+        set_story_metadata(story_data, await call_llm_json(prompt, "final_metadata", METADATA_FORMAT))
+
+    # The rolling summary from enrichment would overwrite the final one
+    async def summary(_):
+        update_story_summary(story_data, await generate_story_summary(story_data["currentStoryText"]))
+
+    async def video(_):
+        # Frames were streamed into the video as the story went; only stories
+        # without a live sink fall back to stitching saved PNGs together
+        if await asyncio.to_thread(close_timeline, story_id) is None:
+            await asyncio.to_thread(images_to_video, f"{folder}/Graphs", timeline_path(story_id))
+
+    async def image(*_):
+        await save_image(story_data, await generate_final_image(build_dalle_prompt(story_data)))
+
+    async def save(*_):
+        await asyncio.to_thread(save_story_data, story_data, folder)
+
+    graph.add("enrichment", enrichment, after=after)
+    graph.add("metadata", metadata, after=after)
+    graph.add("summary", summary, after=["enrichment"])
+    graph.add("video", video, after=["enrichment"])
+    save_after = ["metadata", "summary", *save_after]
+    if with_image:
+        graph.add("image", image, after=["metadata", "summary"])
+        save_after.append("image")
+    graph.add("save", save, after=save_after)
+
+async def finalize_story(story_id: str, with_image: bool = False) -> dict:
+    """
+    Regenerate the metadata and summary from the whole story, save it and
+    finish its timeline video, plus its final illustration if with_image
+    (off by default to save money). Steps that don't need each other's
+    output run at the same time.
+    """
+    story_data = active_stories[story_id]
+    graph = TaskGraph()
+    add_finalisation_steps(graph, story_id, with_image=with_image)
+    with story_scope(story_id):
+        await graph.run()
+    record_finalisation(story_id, graph)
+
+    active_stories.pop(story_id, None)
+    graph_renderer.forget(story_id)
+    forget_index(story_id)
+    journal_state.pop(story_id, None)
+    journal.discard(story_id)
 
     return story_data
 
@@ -483,18 +818,33 @@ def save_story_data(story_data, folder="Stories"):
         json.dump(story_data, f, indent=4) 
 
     print(f"Story data saved to {file_path}")
+    story_archive.add(story_data, file_path)
 
     return story_data
 
-def save_image(image_url, folder="Stories", filename="generated_image.png"):
-    image_data = requests.get(image_url).content
-    os.makedirs(folder, exist_ok=True)
-
-    file_path = os.path.join(folder, filename)
-    # Write the content to a file
-    with open(file_path, "wb") as file:
-        file.write(image_data)
-    print(f"Saved image to {filename}")
+async def save_image(story_data: dict, image_url: str) -> dict:
+    """
+    Keep the story's final image (the URL expires after an hour) and record
+    where it and its thumbnail are in the story data.
+    """
+    stored = await image_store.save(image_url)
+    story_data["finalImage"] = stored
+    print(f"Saved image to {stored['path']}")
+    return stored
+
+# dall-e-3 accepts at most 4000 characters; the fixed text takes about 1200
+DALLE_SUMMARY_TOKENS = 150
+DALLE_CHARACTER_TOKENS = 300
+DALLE_SETTING_TOKENS = 100
+# A prompt of just the story text gets nearly all of the 4000 characters
+DALLE_STORY_TOKENS = 950
+
+def build_story_image_prompt(story_text: str) -> str:
+    """
+    The story text as an image prompt, with the middle elided if it wouldn't
+    fit in DALL-E's limit.
+    """
+    return fit_text([story_text], DALLE_STORY_TOKENS)
 
 def build_dalle_prompt(story_data: dict) -> str:
     metadata = story_data["storyMetadata"]
@@ -504,25 +854,16 @@ def build_dalle_prompt(story_data: dict) -> str:
     style = metadata.get("style", "")
     keywords = ", ".join(metadata.get("themeKeywords", []))
     
-    # Summarize characters
-    character_summaries = []
-    for char in story_data.get("characters", []):
-        name = char.get("name", "Unknown Character")
-        traits = ", ".join(char.get("traits", []))
-        desc = f"{name} ({traits})" if traits else name
-        character_summaries.append(desc)
+    # Summarize characters, capped so the prompt stays inside DALL-E's limit
+    character_summaries = fit_entries(compact_characters(story_data.get("characters", [])), DALLE_CHARACTER_TOKENS)
     characters_str = "\n- " + "\n- ".join(character_summaries) if character_summaries else "None"
     
     # Summarize settings
-    setting_summaries = []
-    for setting in story_data.get("settings", []):
-        location = setting.get("locationName", "Unknown Location")
-        set_desc = setting.get("description", "")
-        setting_summaries.append(f"{location}: {set_desc}")
+    setting_summaries = fit_entries(compact_settings(story_data.get("settings", [])), DALLE_SETTING_TOKENS)
     settings_str = "\n".join(setting_summaries) if setting_summaries else "No specific setting"
 
     # Possibly a truncated or summarized version of the story text
-    story_desc = story_data.get("storySummary", "") 
+    story_desc = fit_text([story_data.get("storySummary", "")], DALLE_SUMMARY_TOKENS)
     
     prompt = f"""
 Create an illustration inspired by the following story and its metadata:
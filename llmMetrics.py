@@ -0,0 +1,262 @@
+import asyncio
+import contextvars
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+# The story a request is made for. Tasks copy the context they are created
+# in, so setting it once per story task tags everything that task starts.
+current_story_id = contextvars.ContextVar("current_story_id", default=None)
+
+def set_current_story(story_id):
+    current_story_id.set(story_id)
+
+@contextmanager
+def story_scope(story_id):
+    token = current_story_id.set(story_id)
+    try:
+        yield
+    finally:
+        current_story_id.reset(token)
+
+
+# USD per million (prompt, completion) tokens
+TOKEN_PRICES = {
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (2.50, 10.00),
+}
+# USD per image
+IMAGE_PRICES = {
+    "dall-e-3": 0.04,
+}
+
+def request_cost(model: str, prompt_tokens: int, completion_tokens: int, images: int = 0) -> float:
+    prompt_price, completion_price = TOKEN_PRICES.get(model, (0.0, 0.0))
+    return ((prompt_tokens * prompt_price + completion_tokens * completion_price) / 1_000_000
+            + images * IMAGE_PRICES.get(model, 0.0))
+
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32, 64)
+TOKEN_BUCKETS = (16, 64, 256, 512, 1024, 2048, 4096, 8192, 16384)
+
+class Histogram():
+    """
+    Cumulative-bucket histogram in the Prometheus sense: counts[i] is how
+    many observations were <= buckets[i]; the last count is +Inf.
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.counts[-1] += 1
+
+    def quantile(self, q: float) -> float:
+        """
+        Upper bound of the bucket holding the q-th observation.
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        for bound, count in zip(self.buckets, self.counts):
+            if count >= rank:
+                return bound
+        return float("inf")
+
+    def prometheus(self, name: str, labels: str) -> list:
+        prefix = labels + "," if labels else ""
+        lines = [f'{name}_bucket{{{prefix}le="{bound}"}} {count}' for bound, count in zip(self.buckets, self.counts)]
+        lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {self.counts[-1]}')
+        lines.append(f"{name}_sum{_braces(labels)} {self.sum:.6f}")
+        lines.append(f"{name}_count{_braces(labels)} {self.count}")
+        return lines
+
+
+class CallStats():
+    """
+    Latency and token histograms plus running totals for one group of
+    requests (one call site and model, or one story).
+    """
+    def __init__(self):
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.prompt_tokens = Histogram(TOKEN_BUCKETS)
+        self.completion_tokens = Histogram(TOKEN_BUCKETS)
+        self.cost = 0.0
+        self.cache_hits = 0
+        self.errors = 0
+
+    def record(self, latency: float, prompt_tokens: int, completion_tokens: int, cost: float):
+        self.latency.observe(latency)
+        self.prompt_tokens.observe(prompt_tokens)
+        self.completion_tokens.observe(completion_tokens)
+        self.cost += cost
+
+    def summary(self) -> dict:
+        return {
+            "calls": self.latency.count,
+            "cacheHits": self.cache_hits,
+            "errors": self.errors,
+            "p50Seconds": self.latency.quantile(0.5),
+            "p95Seconds": self.latency.quantile(0.95),
+            "meanSeconds": round(self.latency.sum / self.latency.count, 3) if self.latency.count else 0.0,
+            "promptTokens": int(self.prompt_tokens.sum),
+            "completionTokens": int(self.completion_tokens.sum),
+            "costUsd": round(self.cost, 6),
+        }
+
+
+def _label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+
+def _braces(labels: str) -> str:
+    return "{" + labels + "}" if labels else ""
+
+class LLMMetrics():
+    """
+    Every OpenAI request the bot makes, by (call site, model) and by story.
+    Only the most recent max_stories stories are kept.
+    """
+    def __init__(self, max_stories: int = 200):
+        self.by_call = {}
+        self.by_story = OrderedDict()
+        self.max_stories = max_stories
+
+    def _stats(self, call_site: str, model: str, story_id):
+        call = self.by_call.get((call_site, model))
+        if call is None:
+            call = self.by_call[(call_site, model)] = CallStats()
+        story = None
+        if story_id is not None:
+            story = self.by_story.get(story_id)
+            if story is None:
+                story = self.by_story[story_id] = CallStats()
+                while len(self.by_story) > self.max_stories:
+                    self.by_story.popitem(last=False)
+            self.by_story.move_to_end(story_id)
+        return [s for s in (call, story) if s is not None]
+
+    def record(self, call_site: str, model: str, latency: float, prompt_tokens: int = 0,
+               completion_tokens: int = 0, images: int = 0, story_id=None):
+        if story_id is None:
+            story_id = current_story_id.get()
+        cost = request_cost(model, prompt_tokens, completion_tokens, images)
+        for stats in self._stats(call_site, model, story_id):
+            stats.record(latency, prompt_tokens, completion_tokens, cost)
+
+    def record_cache_hit(self, call_site: str, model: str):
+        for stats in self._stats(call_site, model, current_story_id.get()):
+            stats.cache_hits += 1
+
+    def record_error(self, call_site: str, model: str):
+        for stats in self._stats(call_site, model, current_story_id.get()):
+            stats.errors += 1
+
+    def summary(self) -> dict:
+        return {
+            "calls": {f"{site} ({model})": stats.summary() for (site, model), stats in self.by_call.items()},
+            "stories": {str(story_id): stats.summary() for story_id, stats in self.by_story.items()},
+        }
+
+    def prometheus_text(self) -> str:
+        calls = [(f'call_site="{_label(site)}",model="{_label(model)}"', stats)
+                 for (site, model), stats in self.by_call.items()]
+        stories = [(f'story_id="{_label(story_id)}"', stats) for story_id, stats in self.by_story.items()]
+
+        # Each metric's samples have to be contiguous, after its TYPE line
+        lines = ["# TYPE llm_request_duration_seconds histogram"]
+        for labels, stats in calls:
+            lines += stats.latency.prometheus("llm_request_duration_seconds", labels)
+        lines.append("# TYPE llm_prompt_tokens histogram")
+        for labels, stats in calls:
+            lines += stats.prompt_tokens.prometheus("llm_prompt_tokens", labels)
+        lines.append("# TYPE llm_completion_tokens histogram")
+        for labels, stats in calls:
+            lines += stats.completion_tokens.prometheus("llm_completion_tokens", labels)
+        lines.append("# TYPE llm_cost_usd_total counter")
+        lines += [f"llm_cost_usd_total{{{labels}}} {stats.cost:.6f}" for labels, stats in calls]
+        lines.append("# TYPE llm_cache_hits_total counter")
+        lines += [f"llm_cache_hits_total{{{labels}}} {stats.cache_hits}" for labels, stats in calls]
+        lines.append("# TYPE llm_errors_total counter")
+        lines += [f"llm_errors_total{{{labels}}} {stats.errors}" for labels, stats in calls]
+
+        lines.append("# TYPE llm_story_request_duration_seconds histogram")
+        for labels, stats in stories:
+            lines += stats.latency.prometheus("llm_story_request_duration_seconds", labels)
+        lines.append("# TYPE llm_story_tokens_total counter")
+        for labels, stats in stories:
+            lines.append(f'llm_story_tokens_total{{{labels},kind="prompt"}} {int(stats.prompt_tokens.sum)}')
+            lines.append(f'llm_story_tokens_total{{{labels},kind="completion"}} {int(stats.completion_tokens.sum)}')
+        lines.append("# TYPE llm_story_cost_usd_total counter")
+        lines += [f"llm_story_cost_usd_total{{{labels}}} {stats.cost:.6f}" for labels, stats in stories]
+        return "\n".join(lines) + "\n"
+
+
+def gauge_lines(name: str, stats_by_labels: dict) -> list:
+    """
+    Prometheus lines for the numeric entries of stats() dicts, one metric
+    per key, e.g. {'call_site="x"': {"hits": 3}} -> name_hits{call_site="x"} 3.
+    Use "" as the labels for an unlabelled dict.
+    """
+    keys = []
+    for values in stats_by_labels.values():
+        keys += [k for k, v in values.items() if k not in keys and not isinstance(v, bool) and isinstance(v, (int, float))]
+
+    lines = []
+    # Grouped by metric so each one's samples are contiguous
+    for key in keys:
+        metric = name + "_" + "".join("_" + c.lower() if c.isupper() else c for c in key)
+        for labels, values in stats_by_labels.items():
+            if key in values:
+                lines.append(f"{metric}{_braces(labels)} {values[key]}")
+    return lines
+
+
+class MetricsServer():
+    """
+    Minimal HTTP server that answers every GET with render()'s Prometheus
+    text, for a local scraper. Binds to localhost only.
+    """
+    def __init__(self, render, host: str = "127.0.0.1", port: int = 9108):
+        self.render = render
+        self.host = host
+        self.port = port
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, self.host, self.port)
+        print(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            # Drain the headers; the request body (if any) is ignored
+            while (await reader.readline()).strip():
+                pass
+            if request_line.split(b" ")[0] == b"GET":
+                body = self.render().encode("utf-8")
+                status = b"200 OK"
+            else:
+                body = b"method not allowed\n"
+                status = b"405 Method Not Allowed"
+            writer.write(b"HTTP/1.1 " + status + b"\r\n"
+                         b"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                         b"Content-Length: " + str(len(body)).encode() + b"\r\n"
+                         b"Connection: close\r\n\r\n" + body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
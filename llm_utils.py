@@ -1,19 +1,380 @@
+import asyncio
+import importlib
 import os
-from openai import OpenAI
+import hashlib
+import threading
+from collections import OrderedDict
 from dotenv import load_dotenv
 import re
 import json
+import time
+from rateLimiter import RateLimiter
+from llmMetrics import LLMMetrics, gauge_lines
 
 load_dotenv()
-client = OpenAI(
-    api_key = os.environ.get("OPENAI_API_KEY")
+
+# One pooled HTTP client shared by every story, so concurrent stories reuse
+# keep-alive connections instead of opening a new one per request.
+_client = None
+_client_options = {}
+
+def configure_client(transport=None, base_url: str = None, api_key: str = None):
+    """
+    Point the client get_client() builds at another endpoint or httpx
+    transport, e.g. openaiStub for offline runs. Call it before the first
+    request (or after close_client()).
+    """
+    global _client
+    _client_options.update(transport=transport, base_url=base_url, api_key=api_key)
+    _client = None
+
+async def preload_client():
+    """
+    Import the SDK (and httpx with it) in a worker thread, so the first
+    request doesn't stall the event loop for the import. Await it before
+    anything can make a request.
+    """
+    await asyncio.to_thread(importlib.import_module, "openai")
+
+def get_client():
+    global _client
+    if _client is None:
+        # The SDK takes over half a second to import, so it waits until preload_client() or the first request
+        import httpx
+        from openai import AsyncOpenAI
+
+        http_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+            timeout=httpx.Timeout(60.0, connect=10.0),
+            transport=_client_options.get("transport"),
+        )
+        _client = AsyncOpenAI(
+            api_key = _client_options.get("api_key") or os.environ.get("OPENAI_API_KEY"),
+            base_url=_client_options.get("base_url"),
+            http_client=http_client,
+            max_retries=0,  # rate_limiter does the retrying
+        )
+    return _client
+
+# Every request in the process goes through this, sized to the account's limits
+rate_limiter = RateLimiter(
+    requests_per_minute=float(os.environ.get("OPENAI_RPM", 500)),
+    tokens_per_minute=float(os.environ.get("OPENAI_TPM", 200000)),
 )
 
+async def close_client():
+    global _client
+    if _client is not None:
+        await _client.close()
+        _client = None
+
+def estimate_tokens(text: str) -> int:
+    # Rough OpenAI tokenizer average for English text (~4 characters per token)
+    return max(1, len(text) // 4)
+
+class LLMCache():
+    """
+    Content-addressed cache of chat completions, keyed by a hash of
+    (model, messages, temperature, max_tokens). Recent entries are kept in an
+    in-memory LRU; every entry is also written to disk so it survives restarts.
+    Disk reads and writes run in worker threads, and the disk tier is pruned
+    back to 90% of max_disk_entries (least recently used first) when it fills.
+    """
+    def __init__(self, max_entries=1000, folder=os.path.join(".cache", "llm"), max_disk_entries=20000):
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self.folder = folder
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        # Files on disk, counted on the first write; guarded by disk_lock
+        self.disk_entries = None
+        self.disk_lock = threading.Lock()
+
+    @staticmethod
+    def key(model: str, messages: list, temperature: float, max_tokens: int, response_format: dict = None) -> str:
+        payload = json.dumps([model, messages, temperature, max_tokens, response_format], sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.folder, key[:2], f"{key}.json")
+
+    def _remember(self, key: str, content: str):
+        self.entries[key] = content
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def _read(self, path: str):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                content = json.load(f)["content"]
+            # The modification time doubles as the last use, for pruning
+            os.utime(path)
+            return content
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _files(self) -> list:
+        files = []
+        for subfolder in os.scandir(self.folder):
+            if subfolder.is_dir():
+                files += [entry for entry in os.scandir(subfolder.path) if entry.name.endswith(".json")]
+        return files
+
+    def _write(self, path: str, content: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        is_new = not os.path.exists(path)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump({"content": content}, f)
+        os.replace(temp_path, path)
+
+        with self.disk_lock:
+            if self.disk_entries is None:
+                self.disk_entries = len(self._files())
+            elif is_new:
+                self.disk_entries += 1
+            if self.disk_entries > self.max_disk_entries:
+                self._prune(int(self.max_disk_entries * 0.9))
+
+    def _prune(self, keep: int):
+        files = sorted(self._files(), key=lambda entry: entry.stat().st_mtime)
+        for entry in files[:max(0, len(files) - keep)]:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+        self.disk_entries = min(len(files), keep)
+
+    async def get(self, key: str):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+
+        content = await asyncio.to_thread(self._read, self._path(key))
+        if content is not None:
+            self._remember(key, content)
+            self.hits += 1
+            self.disk_hits += 1
+            return content
+
+        self.misses += 1
+        return None
+
+    async def put(self, key: str, content: str):
+        if self.entries.get(key) == content:
+            # Already stored, e.g. a reply that was itself a cache hit
+            self.entries.move_to_end(key)
+            return
+        self._remember(key, content)
+        await asyncio.to_thread(self._write, self._path(key), content)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "diskHits": self.disk_hits,
+            "misses": self.misses,
+            "hitRate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "entriesInMemory": len(self.entries),
+        }
+
+llm_cache = LLMCache()
+
+# Latency, tokens and cost of every request, by call site and by story
+llm_metrics = LLMMetrics()
+
+def _usage(response, messages: list, content: str) -> tuple:
+    # Estimate if the endpoint didn't report usage
+    usage = getattr(response, "usage", None)
+    if usage is not None and usage.prompt_tokens is not None:
+        return usage.prompt_tokens, usage.completion_tokens or 0
+    return sum(estimate_tokens(m["content"]) for m in messages), estimate_tokens(content or "")
+
+def metrics_text() -> str:
+    """
+    Prometheus text for the request metrics plus the cache, rate limiter
+    and JSON parsing counters.
+    """
+    lines = gauge_lines("llm_cache", {"": llm_cache.stats()})
+    lines += gauge_lines("llm_rate_limiter", {"": rate_limiter.stats()})
+    lines += gauge_lines("llm_json", {f'call_site="{call_site}"': stats for call_site, stats in json_stats.items()})
+    return llm_metrics.prometheus_text() + "\n".join(lines) + "\n"
+
+async def _chat_completion(messages: list, model: str, temperature: float, max_tokens: int, cache: bool = True,
+                           response_format: dict = None, call_site: str = "chat", store: bool = True) -> str:
+    # Creative, high-temperature calls pass cache=False so they stay varied.
+    # store=False looks the reply up but leaves storing it to the caller, so
+    # JSON call sites only cache replies that parse.
+    key = LLMCache.key(model, messages, temperature, max_tokens, response_format) if cache else None
+    if key is not None:
+        content = await llm_cache.get(key)
+        if content is not None:
+            llm_metrics.record_cache_hit(call_site, model)
+            return content
+
+    estimated_tokens = sum(estimate_tokens(m["content"]) for m in messages) + max_tokens
+    extra = {"response_format": response_format} if response_format else {}
+    # Latency includes time queued behind the rate limiter and any retries
+    start = time.perf_counter()
+    try:
+        response = await rate_limiter.call(
+            lambda: get_client().chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                **extra
+            ),
+            estimated_tokens,
+        )
+    except Exception:
+        llm_metrics.record_error(call_site, model)
+        raise
+
+    choices = response.choices
+    chat_completion = choices[0]
+    content = chat_completion.message.content
+    llm_metrics.record(call_site, model, time.perf_counter() - start, *_usage(response, messages, content))
+
+    if key is not None and store and content:
+        await llm_cache.put(key, content)
+    return content
+
+##########################################################
+######################## JSON Output #####################
+##########################################################
+
+def json_schema_format(name: str, properties: dict) -> dict:
+    """
+    response_format for a strict structured-output object whose properties
+    are all required.
+    """
+    return {
+        "type": "json_schema",
+        "json_schema": {"name": name, "strict": True, "schema": strict_object(properties)},
+    }
+
+def strict_object(properties: dict) -> dict:
+    return {
+        "type": "object",
+        "properties": properties,
+        "required": list(properties),
+        "additionalProperties": False,
+    }
+
+_CODE_FENCE = re.compile(r"```(?:json)?\s*(.*?)```", re.S)
+
+def parse_llm_json(text: str):
+    """
+    Parse JSON from a model reply, tolerating code fences and prose around
+    it. Returns (value, repaired) where repaired says whether the plain parse
+    failed; raises ValueError if no JSON can be found.
+    """
+    if not text:
+        raise ValueError("empty reply")
+    try:
+        return json.loads(text), False
+    except ValueError:
+        pass
+
+    fenced = _CODE_FENCE.search(text)
+    if fenced:
+        try:
+            return json.loads(fenced.group(1)), True
+        except ValueError:
+            pass
+
+    # Fall back to the first complete array/object anywhere in the reply
+    decoder = json.JSONDecoder()
+    for i, c in enumerate(text):
+        if c in "[{":
+            try:
+                value, _ = decoder.raw_decode(text, i)
+                return value, True
+            except ValueError:
+                continue
+    raise ValueError("no JSON found in reply")
+
+# call site -> counters, to see how often replies needed repairing or re-asking
+json_stats = {}
+
+def _count(call_site: str, counter: str):
+    stats = json_stats.setdefault(call_site, {"calls": 0, "repaired": 0, "parseFailures": 0, "reasks": 0, "failed": 0})
+    stats[counter] += 1
+
+def _usable(value, expect, validate):
+    if not isinstance(value, expect):
+        raise ValueError(f"expected {expect.__name__}, got {type(value).__name__}")
+    return validate(value) if validate is not None else value
+
+async def _json_completion(call_site: str, messages: list, model: str, temperature: float, max_tokens: int,
+                           response_format: dict = None, cache: bool = True, expect=dict, validate=None):
+    """
+    Chat completion whose reply must be JSON of type 'expect'. Uses the
+    given structured-output format (plain JSON mode by default), repairs
+    what it can, and only re-asks the model once as a last resort.
+    validate, if given, is called with the parsed value and returns what to
+    hand back, raising ValueError if the reply isn't usable after all.
+    Only a usable reply is cached, under the original request, so a bad
+    one is never replayed. Raises ValueError if the reply still isn't usable.
+    """
+    response_format = response_format or {"type": "json_object"}
+    key = LLMCache.key(model, messages, temperature, max_tokens, response_format) if cache else None
+    _count(call_site, "calls")
+    content = await _chat_completion(messages, model, temperature, max_tokens, cache=cache,
+                                     response_format=response_format, call_site=call_site, store=False)
+    try:
+        value, repaired = parse_llm_json(content)
+        value = _usable(value, expect, validate)
+        if repaired:
+            _count(call_site, "repaired")
+        if key is not None:
+            await llm_cache.put(key, content)
+        return value
+    except ValueError as e:
+        _count(call_site, "parseFailures")
+        print(f"{call_site}: unusable JSON reply ({e}), asking again")
+
+    _count(call_site, "reasks")
+    retry_messages = messages + [
+        {"role": "assistant", "content": content or ""},
+        {"role": "user", "content": "That was not valid JSON in the requested format. Reply again with only the JSON."},
+    ]
+    content = await _chat_completion(retry_messages, model, temperature, max_tokens, cache=False,
+                                     response_format=response_format, call_site=call_site)
+    try:
+        value, _ = parse_llm_json(content)
+        value = _usable(value, expect, validate)
+        if key is not None:
+            await llm_cache.put(key, content)
+        return value
+    except ValueError:
+        _count(call_site, "failed")
+        raise
+
 ##########################################################
 ######################## Text Gen ########################
 ##########################################################
 
-def generate_next_line_candidates_list(story_context: str, num_candidates=3, model="gpt-4o-mini", personality="default") -> list:
+# Structured outputs need an object at the top level, so the list is wrapped
+CANDIDATES_FORMAT = json_schema_format("candidates", {
+    "candidates": {"type": "array", "items": strict_object({"text": {"type": "string"}})},
+})
+
+def _candidate_list(value: dict, minimum: int = 1) -> list:
+    candidates = value.get("candidates")
+    if not isinstance(candidates, list):
+        raise ValueError("reply has no candidates list")
+    candidates = [c for c in candidates if isinstance(c, dict) and isinstance(c.get("text"), str) and c["text"].strip()]
+    if len(candidates) < minimum:
+        raise ValueError(f"expected {minimum} candidates, got {len(candidates)}")
+    return candidates
+
+def build_next_line_messages(story_context: str, num_candidates=3, personality="default") -> list:
 
     system_prompt = "You are a creative writing assistant."
 
@@ -26,34 +387,140 @@ def generate_next_line_candidates_list(story_context: str, num_candidates=3, mod
     user_prompt = (
     f"Story so far:\n{story_context}\n\n"
     f"Please provide exactly {num_candidates} possible next lines. Each line should be 1-2 sentences."
-    f"Format them as a JSON list where each item is a dictionary with a 'text' key.\n\n"
+    f"Format them as a JSON object whose 'candidates' list holds dictionaries with a 'text' key.\n\n"
     f"Example output:\n"
-    f"[\n"
+    f'{{"candidates": [\n'
     f'    {{"text": "...option 1..."}},\n'
     f'    {{"text": "...option 2..."}},\n'
     f'    {{"text": "...option 3..."}}\n'
-    f"]"
+    f"]}}"
     )
 
-    response = client.chat.completions.create(
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "system", "content": "Only ever return english ASCII characters."},
+        {"role": "user", "content": user_prompt}
+    ]
+
+async def generate_next_line_candidates_list(story_context: str, num_candidates=3, model="gpt-4o-mini", personality="default") -> list:
+    return await _json_completion(
+        "next_line_candidates",
+        messages=build_next_line_messages(story_context, num_candidates, personality),
         model=model,
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "system", "content": "Only ever return english ASCII characters."},
-            {"role": "user", "content": user_prompt}
-        ],
         temperature=1.5,
-        max_tokens=300
+        max_tokens=300,
+        response_format=CANDIDATES_FORMAT,
+        cache=False,
+        validate=lambda value: _candidate_list(value, num_candidates)
     )
 
-    choices = response.choices
-    chat_completion = choices[0]
-    content = chat_completion.message.content
-    return content
-
-
-
-def generate_final_line_candidates_list(story_context: str, num_candidates=3, model="gpt-4o-mini", personality="default") -> list:
+class CandidateStreamParser():
+    """
+    Pulls complete {"text": "..."} objects out of a JSON reply that is still
+    being streamed, so each candidate can be used as soon as it is closed.
+    """
+    def __init__(self):
+        self.buffer = ""
+        self.position = 0
+        self.object_starts = []
+        self.in_string = False
+        self.escaped = False
+
+    def feed(self, chunk: str) -> list:
+        """
+        Add streamed text; return the texts of the candidates it completed.
+        """
+        self.buffer += chunk
+        completed = []
+        while self.position < len(self.buffer):
+            c = self.buffer[self.position]
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif c == "\\":
+                    self.escaped = True
+                elif c == '"':
+                    self.in_string = False
+            elif c == '"':
+                self.in_string = True
+            elif c == "{":
+                self.object_starts.append(self.position)
+            elif c == "}" and self.object_starts:
+                start = self.object_starts.pop()
+                try:
+                    candidate = json.loads(self.buffer[start:self.position + 1])
+                except ValueError:
+                    candidate = None
+                if isinstance(candidate, dict) and isinstance(candidate.get("text"), str):
+                    completed.append(candidate["text"])
+            self.position += 1
+        return completed
+
+async def stream_next_line_candidates(story_context: str, num_candidates=3, model="gpt-4o-mini", personality="default"):
+    """
+    Same request as generate_next_line_candidates_list, but streamed: yields
+    each candidate's text as soon as the model has finished writing it.
+    Counted in json_stats as "stream_next_line_candidates"; a reply is only
+    checked for parse failures if it is read to the end.
+    """
+    messages = build_next_line_messages(story_context, num_candidates, personality)
+    max_tokens = 300
+    estimated_tokens = sum(estimate_tokens(m["content"]) for m in messages) + max_tokens
+    _count("stream_next_line_candidates", "calls")
+    start = time.perf_counter()
+    try:
+        stream = await rate_limiter.call(
+            lambda: get_client().chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=1.5,
+                max_tokens=max_tokens,
+                response_format=CANDIDATES_FORMAT,
+                stream=True,
+                stream_options={"include_usage": True}
+            ),
+            estimated_tokens,
+        )
+    except Exception:
+        llm_metrics.record_error("stream_next_line_candidates", model)
+        _count("stream_next_line_candidates", "failed")
+        raise
+
+    parser = CandidateStreamParser()
+    usage_chunk = None
+    try:
+        async for chunk in stream:
+            if getattr(chunk, "usage", None) is not None:
+                # The last chunk carries the usage and no choices
+                usage_chunk = chunk
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                for text in parser.feed(delta):
+                    yield text
+    except Exception:
+        # The connection or the API failed partway through the stream
+        llm_metrics.record_error("stream_next_line_candidates", model)
+        _count("stream_next_line_candidates", "failed")
+        raise
+    else:
+        try:
+            value, repaired = parse_llm_json(parser.buffer)
+            _candidate_list(value, num_candidates)
+            if repaired:
+                _count("stream_next_line_candidates", "repaired")
+        except (ValueError, AttributeError):
+            _count("stream_next_line_candidates", "parseFailures")
+    finally:
+        # Also runs if the poll stops reading early; closing releases the connection
+        await stream.close()
+        llm_metrics.record("stream_next_line_candidates", model, time.perf_counter() - start,
+                           *_usage(usage_chunk, messages, parser.buffer))
+
+
+
+async def generate_final_line_candidates_list(story_context: str, num_candidates=3, model="gpt-4o-mini", personality="default") -> list:
 
     system_prompt = "You are a creative writing assistant."
 
@@ -66,34 +533,37 @@ def generate_final_line_candidates_list(story_context: str, num_candidates=3, mo
     user_prompt = (
     f"Story so far:\n{story_context}\n\n"
     f"Please provide exactly {num_candidates} possible final lines. Each line should be 1-2 sentences."
-    f"Format them as a JSON list where each item is a dictionary with a 'text' key.\n\n"
+    f"Format them as a JSON object whose 'candidates' list holds dictionaries with a 'text' key.\n\n"
     f"Example output:\n"
-    f"[\n"
+    f'{{"candidates": [\n'
     f'    {{"text": "...option 1..."}},\n'
     f'    {{"text": "...option 2..."}},\n'
     f'    {{"text": "...option 3..."}}\n'
-    f"]"
+    f"]}}"
     )
 
-    response = client.chat.completions.create(
-        model=model,
+    return await _json_completion(
+        "final_line_candidates",
         messages=[
             {"role": "system", "content": system_prompt},
             {"role": "system", "content": "Only ever return english ASCII characters."},
             {"role": "user", "content": user_prompt},
         ],
+        model=model,
         temperature=0.8,
-        max_tokens=300
+        max_tokens=300,
+        response_format=CANDIDATES_FORMAT,
+        cache=False,
+        validate=lambda value: _candidate_list(value, num_candidates)
     )
 
-    choices = response.choices
-    chat_completion = choices[0]
-    content = chat_completion.message.content
-
-    return content
-
 def accept_winning_line(llm_output, chosen_line: int):
-    options = json.loads(llm_output)
+    # Takes the candidate list, or a raw JSON reply from older callers
+    options = llm_output
+    if isinstance(options, str):
+        options, _ = parse_llm_json(options)
+        if isinstance(options, dict):
+            options = _candidate_list(options)
     selected_option = options[chosen_line]["text"]
     return selected_option
 
@@ -102,14 +572,23 @@ def accept_winning_line(llm_output, chosen_line: int):
 ######################## Image Gen ########################
 ###########################################################
 
-def generate_final_image(prompt):
-    response =client.images.generate(
-        model ="dall-e-3",
-        prompt=prompt,
-        n=1,
-        size="1024x1024",
-        quality = "standard",
-    )
+async def generate_final_image(prompt):
+    start = time.perf_counter()
+    try:
+        response = await rate_limiter.call(
+            lambda: get_client().images.generate(
+                model ="dall-e-3",
+                prompt=prompt,
+                n=1,
+                size="1024x1024",
+                quality = "standard",
+            ),
+            estimate_tokens(prompt),
+        )
+    except Exception:
+        llm_metrics.record_error("final_image", "dall-e-3")
+        raise
+    llm_metrics.record("final_image", "dall-e-3", time.perf_counter() - start, estimate_tokens(prompt), images=1)
     image_url = response.data[0].url
     print(image_url)
     return image_url
@@ -137,26 +616,49 @@ def generate_final_image(prompt):
 ###########################################################
 
 
-def call_llm_api(request: str, model="gpt-4o-mini") -> list:
+async def call_llm_api(request: str, model="gpt-4o-mini", cache=True, call_site="call_llm_api") -> list:
 
     system_prompt = "You are responsible for populating metadata of a json structure, You are an assistant that returns only valid JSON, with no code fences, no triple backticks, and no additional commentary. Respond with exactly the JSON object described, nothing more."
 
 
     user_prompt = request
-    response = client.chat.completions.create(
-        model=model,
+    content = await _chat_completion(
         messages=[
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": user_prompt}
         ],
+        model=model,
         temperature=1,
-        max_tokens=1000
+        max_tokens=1000,
+        cache=cache,
+        call_site=call_site
     )
 
-    choices = response.choices
-    chat_completion = choices[0]
-    content = chat_completion.message.content
-
     return content
 
+async def call_llm_json(request: str, call_site: str, response_format: dict = None, model="gpt-4o-mini", cache=True) -> dict:
+    """
+    Like call_llm_api but returns the parsed JSON object. Pass a
+    json_schema_format() to get structured outputs; otherwise JSON mode
+    is used. Returns {} if the model never produced usable JSON.
+    """
+    system_prompt = "You are responsible for populating metadata of a json structure, You are an assistant that returns only valid JSON, with no code fences, no triple backticks, and no additional commentary. Respond with exactly the JSON object described, nothing more."
+
+    try:
+        return await _json_completion(
+            call_site,
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": request}
+            ],
+            model=model,
+            temperature=1,
+            max_tokens=1000,
+            response_format=response_format,
+            cache=cache
+        )
+    except ValueError as e:
+        print(f"{call_site}: giving up on JSON reply ({e})")
+        return {}
+
 
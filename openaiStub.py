@@ -0,0 +1,282 @@
+"""
+Local stand-in for the OpenAI endpoints the bot uses, so benchmarks and the
+simulation harness run offline and reproducibly.
+
+In-process (no sockets):
+
+    from openaiStub import OpenAIStub
+    configure_client(**OpenAIStub(latency="lognormal:0.4,0.5", error_rate=0.02).client_options())
+
+Or as a server for another process (OPENAI_BASE_URL=http://127.0.0.1:8089/v1):
+
+    python openaiStub.py --port 8089 --latency exp:0.3 --error-rate 0.05
+
+Replies are a pure function of the request (and the seed): JSON that matches
+the request's json_schema, "{}" for plain JSON mode, a sentence otherwise.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import math
+import random
+import struct
+import time
+import zlib
+
+
+STUB_WORDS = ("the lantern river shadow castle whisper storm garden clock mirror forest door "
+              "stranger letter bridge candle winter harbour secret map tower song").split()
+
+def stub_sentence(rng, low: int = 8, high: int = 16) -> str:
+    return " ".join(rng.choice(STUB_WORDS) for _ in range(rng.randint(low, high))).capitalize() + "."
+
+def sample_schema(schema: dict, rng, name: str = ""):
+    """
+    A value that satisfies a (strict structured-output) JSON schema.
+    """
+    kind = schema.get("type")
+    if kind == "object":
+        return {key: sample_schema(sub, rng, key) for key, sub in schema.get("properties", {}).items()}
+    if kind == "array":
+        # Candidate lists always get the three options the prompts ask for
+        count = 3 if name == "candidates" else rng.randint(0, 2)
+        return [sample_schema(schema.get("items", {}), rng, name) for _ in range(count)]
+    if kind == "integer":
+        return rng.randint(0, 10)
+    if kind == "number":
+        return round(rng.uniform(0, 10), 2)
+    if kind == "boolean":
+        return rng.random() < 0.5
+    if name in ("name", "characterName"):
+        return f"Character {rng.randint(1, 12)}"
+    if name == "locationName":
+        return f"The {rng.choice(STUB_WORDS).capitalize()} {rng.choice(['Hall', 'Woods', 'Quay'])}"
+    # Short phrases for labels and list items (traits, themeKeywords, keyDetails)
+    if name in ("title", "genre", "tone", "style", "status") or name.endswith("s"):
+        return " ".join(rng.choice(STUB_WORDS) for _ in range(rng.randint(1, 3))).title()
+    return stub_sentence(rng)
+
+
+def parse_latency(spec: str):
+    """
+    'fixed:S', 'uniform:LOW,HIGH', 'exp:MEAN' or 'lognormal:MEDIAN,SIGMA'
+    (seconds) -> a function of an RNG returning a delay.
+    """
+    kind, _, params = spec.partition(":")
+    values = [float(v) for v in params.split(",")] if params else []
+    if kind == "fixed":
+        return lambda rng: values[0]
+    if kind == "uniform":
+        return lambda rng: rng.uniform(values[0], values[1])
+    if kind == "exp":
+        return lambda rng: rng.expovariate(1 / values[0]) if values[0] else 0.0
+    if kind == "lognormal":
+        return lambda rng: rng.lognormvariate(math.log(values[0]), values[1])
+    raise ValueError(f"unknown latency distribution: {spec}")
+
+
+def solid_png(rgb: tuple, size: int = 64) -> bytes:
+    """
+    A size x size PNG of one colour, built without any imaging library.
+    """
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+    row = b"\x00" + bytes(rgb) * size
+    return (b"\x89PNG\r\n\x1a\n"
+            + chunk(b"IHDR", struct.pack(">IIBBBBB", size, size, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(row * size))
+            + chunk(b"IEND", b""))
+
+
+class OpenAIStub():
+    """
+    Answers chat completions (plain, JSON mode, json_schema and streamed)
+    and image generations, plus GETs of the image URLs it hands out.
+    Each request waits a delay drawn from 'latency' and fails with a 429
+    (with Retry-After) with probability error_rate.
+    """
+    def __init__(self, latency: str = "fixed:0", error_rate: float = 0.0, seed: int = 0,
+                 stream_chunk: int = 16, stream_delay: float = 0.005, base_url: str = "http://openai.stub/v1"):
+        self.delay = parse_latency(latency)
+        self.error_rate = error_rate
+        self.seed = seed
+        self.stream_chunk = stream_chunk
+        self.stream_delay = stream_delay
+        self.base_url = base_url.rstrip("/")
+        # Latency and errors come from their own stream so replies stay deterministic
+        self.rng = random.Random(seed)
+        self.requests = 0
+        self.throttled = 0
+
+    def client_options(self) -> dict:
+        """
+        Keyword arguments for llm_utils.configure_client.
+        """
+        import httpx
+        return {"transport": httpx.MockTransport(self.handle), "base_url": self.base_url, "api_key": "stub"}
+
+    def reply_rng(self, body: bytes):
+        digest = hashlib.sha256(str(self.seed).encode() + body).digest()
+        return random.Random(int.from_bytes(digest[:8], "big"))
+
+    def chat_content(self, request: dict, rng) -> str:
+        response_format = request.get("response_format") or {}
+        if response_format.get("type") == "json_schema":
+            schema = response_format["json_schema"]
+            return json.dumps(sample_schema(schema["schema"], rng, schema.get("name", "")))
+        if response_format.get("type") == "json_object":
+            return "{}"
+        return stub_sentence(rng, 12, 30)
+
+    def chat_completion(self, request: dict, content: str) -> dict:
+        prompt_tokens = sum(len(m.get("content") or "") for m in request.get("messages", [])) // 4
+        return {
+            "id": "chatcmpl-stub",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "stub"),
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": content}}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(content) // 4,
+                      "total_tokens": prompt_tokens + len(content) // 4},
+        }
+
+    async def chat_stream(self, request: dict, content: str):
+        def event(choices, usage=None) -> bytes:
+            chunk = {"id": "chatcmpl-stub", "object": "chat.completion.chunk", "created": int(time.time()),
+                     "model": request.get("model", "stub"), "choices": choices, "usage": usage}
+            return b"data: " + json.dumps(chunk).encode() + b"\n\n"
+
+        yield event([{"index": 0, "delta": {"role": "assistant", "content": ""}, "finish_reason": None}])
+        for i in range(0, len(content), self.stream_chunk):
+            await asyncio.sleep(self.stream_delay)
+            yield event([{"index": 0, "delta": {"content": content[i:i + self.stream_chunk]}, "finish_reason": None}])
+        yield event([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+        if (request.get("stream_options") or {}).get("include_usage"):
+            yield event([], self.chat_completion(request, content)["usage"])
+        yield b"data: [DONE]\n\n"
+
+    async def respond(self, method: str, path: str, body: bytes):
+        """
+        Returns (status, headers, body bytes or async iterator of bytes).
+        """
+        self.requests += 1
+        if method == "GET" and path.startswith("/images/"):
+            digest = path.rsplit("/", 1)[-1].split(".")[0]
+            return 200, {"content-type": "image/png"}, solid_png(tuple(bytes.fromhex(digest[:6].ljust(6, "0"))))
+
+        await asyncio.sleep(self.delay(self.rng))
+        if self.error_rate and self.rng.random() < self.error_rate:
+            self.throttled += 1
+            error = {"error": {"message": "Rate limit reached (stub)", "type": "requests", "code": "rate_limit_exceeded"}}
+            return 429, {"content-type": "application/json", "retry-after-ms": "200"}, json.dumps(error).encode()
+
+        request = json.loads(body or b"{}")
+        rng = self.reply_rng(body)
+        if path.endswith("/chat/completions"):
+            content = self.chat_content(request, rng)
+            if request.get("stream"):
+                return 200, {"content-type": "text/event-stream"}, self.chat_stream(request, content)
+            return 200, {"content-type": "application/json"}, json.dumps(self.chat_completion(request, content)).encode()
+        if path.endswith("/images/generations"):
+            digest = hashlib.sha256(body).hexdigest()[:16]
+            data = [{"url": f"{self.base_url}/images/{digest}.png", "revised_prompt": request.get("prompt", "")}]
+            return 200, {"content-type": "application/json"}, json.dumps({"created": int(time.time()), "data": data}).encode()
+        return 404, {"content-type": "application/json"}, b'{"error": {"message": "not stubbed"}}'
+
+    async def handle(self, request):
+        """
+        httpx.MockTransport handler.
+        """
+        import httpx
+        path = request.url.path
+        prefix = httpx.URL(self.base_url).path.rstrip("/")
+        if path.startswith(prefix):
+            path = path[len(prefix):]
+        status, headers, body = await self.respond(request.method, path, request.content)
+        return httpx.Response(status, headers=headers, content=body)
+
+
+class StubServer():
+    """
+    Serves an OpenAIStub over HTTP/1.1 on localhost, one request per
+    connection, for processes that can't share the in-process transport.
+    """
+    def __init__(self, stub: OpenAIStub, host: str = "127.0.0.1", port: int = 8089):
+        self.stub = stub
+        self.host = host
+        self.port = port
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.stub.base_url = f"http://{self.host}:{self.port}/v1"
+        print(f"OpenAI stub listening on {self.stub.base_url}")
+
+    async def _handle(self, reader, writer):
+        try:
+            method, target, _ = (await reader.readline()).decode().split(" ", 2)
+            length = 0
+            while True:
+                line = (await reader.readline()).strip()
+                if not line:
+                    break
+                name, _, value = line.decode().partition(":")
+                if name.lower() == "content-length":
+                    length = int(value)
+            body = await reader.readexactly(length) if length else b""
+
+            path = target.split("?", 1)[0]
+            if path.startswith("/v1"):
+                path = path[3:]
+            status, headers, content = await self.stub.respond(method, path, body)
+
+            head = [f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}", "Connection: close"]
+            head += [f"{name}: {value}" for name, value in headers.items()]
+            if isinstance(content, bytes):
+                head.append(f"Content-Length: {len(content)}")
+            writer.write(("\r\n".join(head) + "\r\n\r\n").encode())
+            if isinstance(content, bytes):
+                writer.write(content)
+            else:
+                # Streamed: the body ends when the connection closes
+                async for piece in content:
+                    writer.write(piece)
+                    await writer.drain()
+            await writer.drain()
+        except (ConnectionError, ValueError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency", default="fixed:0", help="fixed:S, uniform:LOW,HIGH, exp:MEAN or lognormal:MEDIAN,SIGMA")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with a 429")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    async def run():
+        server = StubServer(OpenAIStub(args.latency, args.error_rate, args.seed), port=args.port)
+        await server.start()
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await server.close()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+import asyncio
+from random import randint
+
+
+POLL_REACTIONS = ['1️⃣', '2️⃣', '3️⃣']
+
+class Poll():
+    """
+    Votes on one poll message, kept from reaction events as they arrive.
+    Each voter has one vote: their most recent reaction that is still on the
+    message. With voters=None anyone but the bot may vote.
+    """
+    def __init__(self, message_id, voters=None, reactions=POLL_REACTIONS):
+        self.message_id = message_id
+        self.voters = set(voters) if voters else None
+        self.reactions = list(reactions)
+        self.option_count = 0
+        # user id -> option indices they have reacted with, oldest first
+        self.choices = {}
+        self.waiting = False
+        self.decided = asyncio.Event()
+
+    def votes(self) -> list:
+        counts = [0] * self.option_count
+        for indices in self.choices.values():
+            valid = [i for i in indices if i < self.option_count]
+            if valid:
+                counts[valid[-1]] += 1
+        return counts
+
+    def react(self, user_id, emoji: str, added: bool):
+        if self.voters is not None and user_id not in self.voters:
+            return
+        if emoji not in self.reactions:
+            return
+        index = self.reactions.index(emoji)
+        indices = self.choices.setdefault(user_id, [])
+        if index in indices:
+            indices.remove(index)
+        if added:
+            indices.append(index)
+        self._check()
+
+    def _check(self):
+        # Only decide early once all options are up and the timer has started
+        if not self.waiting or self.option_count == 0:
+            return
+        counts = self.votes()
+        voted = sum(counts)
+        if self.voters is not None:
+            remaining = len(self.voters) - voted
+            if remaining <= 0:
+                self.decided.set()
+                return
+            ranked = sorted(counts, reverse=True) + [0]
+            # Even if every remaining voter backs the runner-up it can't catch up
+            if ranked[0] - ranked[1] > remaining:
+                self.decided.set()
+
+    def winner(self) -> int:
+        """
+        The option with the most votes (the lowest on a tie), or a random
+        one if nobody voted.
+        """
+        counts = self.votes()
+        if not any(counts):
+            return randint(0, max(self.option_count, 1) - 1)
+        return counts.index(max(counts))
+
+    async def wait(self, timeout: float, option_count: int) -> int:
+        """
+        Wait until the vote is decided or timeout seconds pass, then return
+        the winning option's index.
+        """
+        self.option_count = option_count
+        self.waiting = True
+        self._check()
+        try:
+            await asyncio.wait_for(self.decided.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self.winner()
+
+
+class PollEngine():
+    """
+    Routes raw reaction add/remove events to the open polls by message id,
+    so results never need the message fetched back from Discord.
+    """
+    def __init__(self):
+        self.polls = {}
+
+    def open(self, message_id, voters=None) -> Poll:
+        poll = Poll(message_id, voters)
+        self.polls[message_id] = poll
+        return poll
+
+    def close(self, message_id):
+        self.polls.pop(message_id, None)
+
+    def handle(self, message_id, user_id, emoji: str, added: bool):
+        poll = self.polls.get(message_id)
+        if poll is not None:
+            poll.react(user_id, emoji, added)
+
+    async def result(self, message_id, timeout: float, option_count: int) -> int:
+        poll = self.polls.get(message_id)
+        try:
+            return await poll.wait(timeout, option_count)
+        finally:
+            self.close(message_id)
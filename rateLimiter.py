@@ -0,0 +1,151 @@
+import asyncio
+import random
+import time
+
+
+class TokenBucket():
+    """
+    Refills at rate_per_minute up to capacity (one minute's worth by default).
+    acquire() waits until the requested amount is available.
+    """
+    def __init__(self, rate_per_minute: float, capacity: float = None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity or rate_per_minute
+        self.available = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount: float = 1):
+        amount = min(amount, self.capacity)
+        # The lock keeps waiters in order so a large request isn't starved
+        async with self.lock:
+            self._refill()
+            while self.available < amount:
+                await asyncio.sleep((amount - self.available) / self.rate)
+                self._refill()
+            self.available -= amount
+
+
+class AdaptiveConcurrency():
+    """
+    AIMD limit on requests in flight: every success raises the limit by
+    1/limit (about +1 per round of requests), every throttle halves it.
+    """
+    def __init__(self, initial: int = 8, minimum: int = 1, maximum: int = 64):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.in_flight = 0
+        self.last_decrease = 0.0
+        self.condition = asyncio.Condition()
+
+    async def acquire(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def release(self, throttled: bool = False, succeeded: bool = False):
+        async with self.condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if throttled:
+                # Concurrent 429s from the same burst only count once
+                if now - self.last_decrease > 1.0:
+                    self.limit = max(self.minimum, self.limit / 2)
+                    self.last_decrease = now
+            elif succeeded:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+
+def retryable_errors() -> tuple:
+    # Imported on first use so importing this module doesn't load the SDK
+    import openai
+
+    return (
+        openai.RateLimitError,
+        openai.APIConnectionError,  # includes APITimeoutError
+        openai.InternalServerError,
+    )
+
+class RateLimiter():
+    """
+    Process-wide gate for OpenAI requests: request and token buckets sized to
+    the account's per-minute limits, AIMD concurrency, and retries with
+    jittered exponential backoff that honour Retry-After.
+    """
+    def __init__(self, requests_per_minute: float = 500, tokens_per_minute: float = 200000,
+                 max_concurrency: int = 64, max_retries: int = 6, base_delay: float = 0.5, max_delay: float = 30.0):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.concurrency = AdaptiveConcurrency(initial=min(8, max_concurrency), maximum=max_concurrency)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retries = 0
+        self.throttled = 0
+
+    @staticmethod
+    def retry_after(error) -> float:
+        response = getattr(error, "response", None)
+        if response is None:
+            return None
+        headers = response.headers
+        try:
+            if "retry-after-ms" in headers:
+                return float(headers["retry-after-ms"]) / 1000
+            if "retry-after" in headers:
+                return float(headers["retry-after"])
+        except ValueError:
+            pass
+        return None
+
+    def backoff(self, attempt: int) -> float:
+        # "Full jitter": spreads retries from many stories over the window
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    async def call(self, make_request, estimated_tokens: int = 1):
+        """
+        Await make_request() (a no-argument coroutine function) once the
+        limits allow, retrying rate limits and transient errors.
+        """
+        for attempt in range(self.max_retries + 1):
+            await self.requests.acquire(1)
+            await self.tokens.acquire(estimated_tokens)
+
+            await self.concurrency.acquire()
+            throttled = succeeded = False
+            try:
+                response = await make_request()
+                succeeded = True
+                return response
+            except Exception as e:
+                retryable = retryable_errors()
+                if not isinstance(e, retryable):
+                    raise
+                throttled = isinstance(e, retryable[0])
+                if attempt == self.max_retries:
+                    raise
+                delay = self.retry_after(e) if throttled else None
+                if delay is None:
+                    delay = self.backoff(attempt)
+                self.retries += 1
+                self.throttled += throttled
+                print(f"OpenAI request failed ({type(e).__name__}), retrying in {delay:.1f}s")
+            finally:
+                await self.concurrency.release(throttled=throttled, succeeded=succeeded)
+
+            await asyncio.sleep(delay)
+
+    def stats(self) -> dict:
+        return {
+            "concurrencyLimit": int(self.concurrency.limit),
+            "inFlight": self.concurrency.in_flight,
+            "retries": self.retries,
+            "throttled": self.throttled,
+        }
@@ -0,0 +1,194 @@
+import glob
+import json
+import os
+import sqlite3
+import threading
+
+
+class StoryArchive():
+    """
+    SQLite index of finished stories. Metadata lives in plain columns for
+    filtering and the title, summary, keywords and text in an FTS5 table for
+    full text search. The story JSON itself stays where save_story_data wrote
+    it and is only read when load() asks for one story.
+    """
+    def __init__(self, db_path=os.path.join("Stories", "archive.db")):
+        self.db_path = db_path
+        self.conn = None
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        if self.conn is None:
+            os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+            # Shared with the backfill thread; every use goes through self.lock
+            self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self.conn.row_factory = sqlite3.Row
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS stories (
+                    id INTEGER PRIMARY KEY,
+                    path TEXT UNIQUE NOT NULL,
+                    story_id TEXT,
+                    title TEXT,
+                    genre TEXT COLLATE NOCASE,
+                    tone TEXT COLLATE NOCASE,
+                    style TEXT,
+                    authors TEXT COLLATE NOCASE,
+                    keywords TEXT COLLATE NOCASE,
+                    summary TEXT,
+                    line_count INTEGER,
+                    created TEXT,
+                    mtime REAL
+                );
+                CREATE INDEX IF NOT EXISTS stories_genre ON stories (genre);
+                CREATE INDEX IF NOT EXISTS stories_tone ON stories (tone);
+                CREATE VIRTUAL TABLE IF NOT EXISTS stories_fts USING fts5 (title, summary, keywords, text);
+            """)
+        return self.conn
+
+    @staticmethod
+    def _authors(story_data: dict) -> list:
+        authors = [story_data.get("storyMetadata", {}).get("createdBy", "")]
+        authors += [line.get("addedBy", "") for line in story_data.get("lines", [])]
+        # The bot's own lines aren't an author
+        return sorted({a for a in authors if a and a not in ("bot", "llm")})
+
+    def add(self, story_data: dict, path: str):
+        """
+        Index (or re-index) the story saved at path.
+        """
+        metadata = story_data.get("storyMetadata", {})
+        keywords = metadata.get("themeKeywords", [])
+        authors = self._authors(story_data)
+        mtime = os.path.getmtime(path) if os.path.exists(path) else None
+        row = (
+            os.path.normpath(path),
+            str(story_data.get("story_Id", story_data.get("storyId", ""))),
+            story_data.get("title", ""),
+            metadata.get("genre", ""),
+            metadata.get("tone", ""),
+            metadata.get("style", ""),
+            # Delimited so a LIKE '%|name|%' only matches whole entries
+            "|" + "|".join(authors) + "|",
+            "|" + "|".join(keywords) + "|",
+            story_data.get("storySummary", ""),
+            len(story_data.get("lines", [])),
+            metadata.get("creationDate", ""),
+            mtime,
+        )
+
+        with self.lock:
+            conn = self._connect()
+            with conn:
+                existing = conn.execute("SELECT id FROM stories WHERE path = ?", (row[0],)).fetchone()
+                if existing:
+                    conn.execute("DELETE FROM stories WHERE id = ?", (existing["id"],))
+                    conn.execute("DELETE FROM stories_fts WHERE rowid = ?", (existing["id"],))
+                cursor = conn.execute("""
+                    INSERT INTO stories (path, story_id, title, genre, tone, style, authors, keywords, summary, line_count, created, mtime)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """, row)
+                conn.execute(
+                    "INSERT INTO stories_fts (rowid, title, summary, keywords, text) VALUES (?, ?, ?, ?, ?)",
+                    (cursor.lastrowid, row[2], row[8], " ".join(keywords), story_data.get("currentStoryText", "")),
+                )
+
+    def backfill(self, root="Stories") -> int:
+        """
+        Index every story JSON under root that is new or changed since it was
+        last indexed. Returns how many were (re)indexed.
+        """
+        with self.lock:
+            known = {r["path"]: r["mtime"] for r in self._connect().execute("SELECT path, mtime FROM stories")}
+
+        indexed = 0
+        for path in glob.glob(os.path.join(root, "**", "*.json"), recursive=True):
+            path = os.path.normpath(path)
+            if known.get(path) == os.path.getmtime(path):
+                continue
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    story_data = json.load(f)
+            except (OSError, json.JSONDecodeError) as e:
+                print(f"Skipping {path}: {e}")
+                continue
+            if not isinstance(story_data, dict) or "lines" not in story_data:
+                continue
+            self.add(story_data, path)
+            indexed += 1
+        return indexed
+
+    @staticmethod
+    def _fts_query(text: str) -> str:
+        # Quote every word so user input can't be read as FTS syntax
+        return " ".join('"' + word.replace('"', '""') + '"' for word in text.split())
+
+    @staticmethod
+    def _entry_pattern(value: str) -> str:
+        # Escape LIKE's wildcards so e.g. "author:%" only matches an author called %
+        escaped = value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        return f"%|{escaped}|%"
+
+    def search(self, text: str = None, genre: str = None, tone: str = None, keyword: str = None,
+               author: str = None, page: int = 1, per_page: int = 5):
+        """
+        Find stories matching every given filter. Returns (rows for the
+        page, total number of matches); rows carry metadata only.
+        """
+        clauses, params = [], []
+        if text:
+            clauses.append("s.id IN (SELECT rowid FROM stories_fts WHERE stories_fts MATCH ?)")
+            params.append(self._fts_query(text))
+        if genre:
+            clauses.append("s.genre = ?")
+            params.append(genre)
+        if tone:
+            clauses.append("s.tone = ?")
+            params.append(tone)
+        if keyword:
+            clauses.append("s.keywords LIKE ? ESCAPE '\\'")
+            params.append(self._entry_pattern(keyword))
+        if author:
+            clauses.append("s.authors LIKE ? ESCAPE '\\'")
+            params.append(self._entry_pattern(author))
+        where = "WHERE " + " AND ".join(clauses) if clauses else ""
+        offset = (max(page, 1) - 1) * per_page
+
+        with self.lock:
+            conn = self._connect()
+            total = conn.execute(f"SELECT COUNT(*) FROM stories s {where}", params).fetchone()[0]
+            rows = conn.execute(f"""
+                SELECT s.id, s.story_id, s.title, s.genre, s.tone, s.authors, s.keywords, s.line_count, s.created
+                FROM stories s {where}
+                ORDER BY s.created DESC, s.id DESC
+                LIMIT ? OFFSET ?
+            """, params + [per_page, offset]).fetchall()
+
+        results = []
+        for r in rows:
+            result = dict(r)
+            result["authors"] = [a for a in r["authors"].split("|") if a]
+            result["keywords"] = [k for k in r["keywords"].split("|") if k]
+            results.append(result)
+        return results, total
+
+    def load(self, archive_id: int):
+        """
+        Read one archived story's full JSON from disk, or None.
+        """
+        with self.lock:
+            row = self._connect().execute("SELECT path FROM stories WHERE id = ?", (archive_id,)).fetchone()
+        if row is None or not os.path.exists(row["path"]):
+            return None
+        with open(row["path"], "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+
+# Shared archive for the bot and save_story_data
+story_archive = StoryArchive()
@@ -0,0 +1,115 @@
+from llm_utils import estimate_tokens
+
+
+def story_header(story_data: dict) -> list:
+    metadata = story_data.get("storyMetadata", {})
+    header = [f"Title: {story_data.get('title', '')}"]
+    for label, key in (("Genre", "genre"), ("Tone", "tone"), ("Style", "style")):
+        if metadata.get(key):
+            header.append(f"{label}: {metadata[key]}")
+    if metadata.get("themeKeywords"):
+        header.append("Keywords: " + ", ".join(metadata["themeKeywords"]))
+    return header
+
+def compact_characters(characters: list) -> list:
+    """
+    One line per character: name, traits, description and status, with
+    opinions cut down to who they are about and the trust level.
+    """
+    entries = []
+    for character in characters:
+        entry = character.get("name", "Unknown Character")
+        if character.get("traits"):
+            entry += f" ({', '.join(character['traits'])})"
+        details = [d.rstrip(".") for d in (character.get("description"), character.get("status")) if d]
+        if details:
+            entry += ": " + "; ".join(details)
+        opinions = [f"{o.get('characterName')} {o.get('trustLevel', '?')}/10" for o in character.get("opinionsOf") or []]
+        if opinions:
+            entry += f" [trusts {', '.join(opinions)}]"
+        entries.append(entry)
+    return entries
+
+def compact_settings(settings: list) -> list:
+    entries = []
+    for setting in settings:
+        entry = setting.get("locationName", "Unknown Location")
+        if setting.get("description"):
+            entry += f": {setting['description']}"
+        entries.append(entry)
+    return entries
+
+def story_lines(story_data: dict) -> list:
+    """
+    The story text once, as its lines; currentStoryText is only used for
+    stories saved without lines. Repeated lines are dropped.
+    """
+    texts = [line.get("text", "").strip() for line in story_data.get("lines", [])]
+    if not any(texts):
+        texts = [story_data.get("currentStoryText", "").strip()]
+    lines, seen = [], set()
+    for text in texts:
+        if text and text not in seen:
+            seen.add(text)
+            lines.append(text)
+    return lines
+
+def fit_entries(entries: list, token_budget: int) -> list:
+    """
+    As many entries as fit in the budget, noting how many were left out.
+    """
+    kept, used = [], 0
+    for i, entry in enumerate(entries):
+        cost = estimate_tokens(entry) + 1
+        if used + cost > token_budget:
+            kept.append(f"(and {len(entries) - i} more)")
+            break
+        kept.append(entry)
+        used += cost
+    return kept
+
+def fit_text(lines: list, token_budget: int) -> str:
+    """
+    The lines joined, or if too long the opening and the ending with the
+    middle elided; the ending gets the larger share since it matters most
+    for judging a finished story.
+    """
+    text = " ".join(lines)
+    if estimate_tokens(text) <= token_budget:
+        return text
+    chars = token_budget * 4
+    if chars <= 0:
+        return "[...]"
+    head = chars // 3
+    tail = chars - head
+    return text[:head].rstrip() + " [...] " + text[-tail:].lstrip()
+
+def compact_story(story_data: dict, token_budget: int = 1500, include_text: bool = True) -> str:
+    """
+    Plain-text digest of a story for prompts, within roughly token_budget
+    tokens. Keeps the metadata that describes the story, the summary, the
+    story text once and a compact cast list; ids, timestamps, authors and
+    the opinion text are dropped. Characters and settings get at most a
+    third of the budget and the text whatever is left.
+    """
+    sections = ["\n".join(story_header(story_data))]
+    summary = story_data.get("storySummary", "").strip()
+    lines = story_lines(story_data) if include_text else []
+    if summary and summary != " ".join(lines):
+        sections.append(f"Summary: {summary}")
+
+    remaining = token_budget - sum(estimate_tokens(s) for s in sections)
+    cast_budget = remaining // 3 if include_text else remaining
+    characters = compact_characters(story_data.get("characters", []))
+    settings = compact_settings(story_data.get("settings", []))
+    if characters:
+        kept = fit_entries(characters, cast_budget * 2 // 3 if settings else cast_budget)
+        sections.append("Characters:\n- " + "\n- ".join(kept))
+    if settings:
+        kept = fit_entries(settings, cast_budget // 3 if characters else cast_budget)
+        sections.append("Settings:\n- " + "\n- ".join(kept))
+
+    if lines:
+        remaining = token_budget - sum(estimate_tokens(s) for s in sections)
+        sections.append("Story:\n" + fit_text(lines, remaining))
+    return "\n\n".join(sections)
@@ -0,0 +1,91 @@
+class StoryIndex():
+    """
+    Name-keyed lookups over a story's characters and settings lists, plus a
+    (source, target) -> opinion map. The index holds the very same dicts as
+    the lists and appends through to them, so story_data serialises to exactly
+    the same JSON as before.
+    """
+    def __init__(self, characters: list, settings: list = None):
+        self.characters = characters
+        self.settings = settings if settings is not None else []
+        self.characters_by_name = {}
+        self.settings_by_name = {}
+        self.opinions = {}
+
+        for character in self.characters:
+            self._index_character(character)
+        for setting in self.settings:
+            self.settings_by_name.setdefault(setting["locationName"], setting)
+        self.character_count = len(self.characters)
+        self.setting_count = len(self.settings)
+
+    def _index_character(self, character: dict):
+        name = character["name"]
+        # First entry wins, matching the old linear scans
+        if name in self.characters_by_name:
+            return
+        self.characters_by_name[name] = character
+        for opinion in character.get("opinionsOf") or []:
+            self.opinions.setdefault((name, opinion["characterName"]), opinion)
+
+    def in_sync(self, story_data: dict) -> bool:
+        """
+        True if story_data still holds the lists this index was built from
+        and nothing has been appended to them behind its back.
+        """
+        return (story_data.get("characters") is self.characters
+                and story_data.get("settings") is self.settings
+                and len(self.characters) == self.character_count
+                and len(self.settings) == self.setting_count)
+
+    def character(self, name: str):
+        return self.characters_by_name.get(name)
+
+    def setting(self, location_name: str):
+        return self.settings_by_name.get(location_name)
+
+    def opinion(self, source: str, target: str):
+        return self.opinions.get((source, target))
+
+    def add_character(self, character: dict) -> bool:
+        """
+        Append the character unless one with the same name exists.
+        Returns True if it was added.
+        """
+        if character["name"] in self.characters_by_name:
+            return False
+        self.characters.append(character)
+        self.character_count += 1
+        self._index_character(character)
+        return True
+
+    def add_setting(self, setting: dict) -> bool:
+        """
+        Append the setting unless one with the same locationName exists.
+        Returns True if it was added.
+        """
+        if setting["locationName"] in self.settings_by_name:
+            return False
+        self.settings.append(setting)
+        self.setting_count += 1
+        self.settings_by_name[setting["locationName"]] = setting
+        return True
+
+
+# story_id -> StoryIndex for the live stories
+_indexes = {}
+
+def index_for(story_data: dict) -> StoryIndex:
+    """
+    The index for a story, rebuilt only if its lists were replaced or edited
+    outside the index (e.g. after loading from disk).
+    """
+    story_id = story_data.get("story_Id")
+    index = _indexes.get(story_id)
+    if index is None or not index.in_sync(story_data):
+        index = StoryIndex(story_data.setdefault("characters", []), story_data.setdefault("settings", []))
+        _indexes[story_id] = index
+    return index
+
+def forget_index(story_id):
+    _indexes.pop(story_id, None)
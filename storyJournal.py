@@ -0,0 +1,219 @@
+import asyncio
+import json
+import os
+import threading
+
+
+class StoryJournal():
+    """
+    Append-only JSONL log of every change to a live story, one file per story,
+    plus a compacted snapshot written every compact_every records. Replaying
+    the snapshot and then the journal rebuilds the story after a crash.
+
+    Each record is one line, flushed before append() returns and fsynced in a
+    worker thread straight after, so the event loop never waits on the disk.
+    A crash can leave a torn line; load() skips it and the next append starts
+    on a fresh line.
+
+    Records are numbered and the snapshot notes the last one it includes, so
+    replay skips whatever a crash mid-compaction left in the journal. To
+    compact, the journal is set aside (new records go to a fresh file) and
+    the snapshot is written in a worker thread, which then deletes it.
+    """
+    def __init__(self, folder=os.path.join("Stories", ".journal"), compact_every=50, fsync=True):
+        self.folder = folder
+        self.compact_every = compact_every
+        self.fsync = fsync
+        self.files = {}
+        self.records_since_snapshot = {}
+        # Stories with an fsync running, and those written to since it started
+        self.syncing = set()
+        self.dirty = set()
+        # story_id -> number of the last record appended
+        self.sequence = {}
+        # Stories with a snapshot being written; guarded by snapshot_lock
+        self.snapshotting = set()
+        self.snapshot_lock = threading.Lock()
+
+    def _paths(self, story_id):
+        name = str(story_id)
+        return (os.path.join(self.folder, f"{name}.jsonl"),
+                os.path.join(self.folder, f"{name}.snapshot.json"))
+
+    def _compacting_path(self, story_id):
+        # The journal set aside while its snapshot is written
+        return os.path.join(self.folder, f"{story_id}.compacting.jsonl")
+
+    def _file(self, story_id):
+        f = self.files.get(story_id)
+        if f is None:
+            os.makedirs(self.folder, exist_ok=True)
+            journal_path, _ = self._paths(story_id)
+            f = open(journal_path, "a", encoding="utf-8")
+            if f.tell() > 0 and not self._ends_with_newline(journal_path):
+                # Don't append onto a line torn by a crash
+                f.write("\n")
+            self.files[story_id] = f
+        return f
+
+    @staticmethod
+    def _ends_with_newline(path) -> bool:
+        with open(path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b"\n"
+
+    def _sync(self, f):
+        f.flush()
+        if self.fsync:
+            os.fsync(f.fileno())
+
+    def _sync_soon(self, story_id, f):
+        """
+        Flush now and fsync in a worker thread. Records written while an
+        fsync is running are covered by one more fsync after it.
+        """
+        f.flush()
+        if not self.fsync:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            os.fsync(f.fileno())
+            return
+        if story_id in self.syncing:
+            self.dirty.add(story_id)
+            return
+        self.syncing.add(story_id)
+
+        def done(future):
+            self.syncing.discard(story_id)
+            # The file may have been closed by discard() in the meantime
+            if not future.cancelled():
+                future.exception()
+            if story_id in self.dirty:
+                self.dirty.discard(story_id)
+                if self.files.get(story_id) is f:
+                    self._sync_soon(story_id, f)
+
+        loop.run_in_executor(None, os.fsync, f.fileno()).add_done_callback(done)
+
+    def append(self, story_id, record: dict, state=None):
+        """
+        Append one record. 'state' is a callable returning the full snapshot
+        payload; it is only called when the journal is due for compaction.
+        """
+        f = self._file(story_id)
+        sequence = self.sequence.get(story_id, 0) + 1
+        self.sequence[story_id] = sequence
+        f.write(json.dumps({**record, "seq": sequence}) + "\n")
+        self._sync_soon(story_id, f)
+
+        count = self.records_since_snapshot.get(story_id, 0) + 1
+        self.records_since_snapshot[story_id] = count
+        if state is not None and count >= self.compact_every and story_id not in self.snapshotting:
+            self.snapshot(story_id, state())
+
+    def snapshot(self, story_id, payload: dict):
+        """
+        Atomically replace the story's snapshot and empty its journal. The
+        payload is serialised straight away; the writing and fsyncs happen
+        in a worker thread when there is a running event loop.
+        """
+        os.makedirs(self.folder, exist_ok=True)
+        journal_path, _ = self._paths(story_id)
+        data = json.dumps({**payload, "journalSeq": self.sequence.get(story_id, 0)})
+
+        # Later records go to a fresh journal while this one is compacted
+        f = self.files.pop(story_id, None)
+        if f is not None:
+            f.close()
+        with self.snapshot_lock:
+            self.snapshotting.add(story_id)
+            if os.path.exists(journal_path):
+                os.replace(journal_path, self._compacting_path(story_id))
+        self.records_since_snapshot[story_id] = 0
+
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._write_snapshot(story_id, data)
+            return
+        future = loop.run_in_executor(None, self._write_snapshot, story_id, data)
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+
+    def _write_snapshot(self, story_id, data: str):
+        _, snapshot_path = self._paths(story_id)
+        temp_path = snapshot_path + ".tmp"
+        with self.snapshot_lock:
+            # discard() got there first
+            if story_id not in self.snapshotting:
+                return
+            try:
+                with open(temp_path, "w", encoding="utf-8") as f:
+                    f.write(data)
+                    self._sync(f)
+                os.replace(temp_path, snapshot_path)
+                os.remove(self._compacting_path(story_id))
+            finally:
+                self.snapshotting.discard(story_id)
+
+    def load(self, story_id):
+        """
+        Return (snapshot payload or None, list of records written after it).
+        """
+        journal_path, snapshot_path = self._paths(story_id)
+        snapshot = None
+        if os.path.exists(snapshot_path):
+            with open(snapshot_path, "r", encoding="utf-8") as f:
+                snapshot = json.load(f)
+        # Snapshots from before records were numbered cover none of the journal
+        covered = snapshot.get("journalSeq", -1) if snapshot else -1
+
+        records = []
+        last = max(covered, 0)
+        # A journal set aside for a snapshot that didn't finish comes first
+        for path in (self._compacting_path(story_id), journal_path):
+            if not os.path.exists(path):
+                continue
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A write torn by a crash; later records start on a new line
+                        continue
+                    sequence = record.get("seq", 0)
+                    last = max(last, sequence)
+                    if sequence > covered:
+                        records.append(record)
+        self.sequence[story_id] = last
+        self.records_since_snapshot[story_id] = len(records)
+        return snapshot, records
+
+    def story_ids(self) -> list:
+        if not os.path.isdir(self.folder):
+            return []
+        names = {name.split(".", 1)[0] for name in os.listdir(self.folder)
+                 if name.endswith(".jsonl") or name.endswith(".snapshot.json")}
+        return [int(name) if name.isdigit() else name for name in sorted(names)]
+
+    def discard(self, story_id):
+        """
+        Forget a story once it is finished.
+        """
+        f = self.files.pop(story_id, None)
+        if f is not None:
+            f.close()
+        self.records_since_snapshot.pop(story_id, None)
+        self.sequence.pop(story_id, None)
+        self.dirty.discard(story_id)
+        with self.snapshot_lock:
+            self.snapshotting.discard(story_id)
+            for path in (*self._paths(story_id), self._compacting_path(story_id)):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.files.clear()
@@ -1,22 +1,35 @@
+"""
+Score finished stories with the LLM.
+
+    python storyRanking.py [--root Stories] [--results Stories/rankings.jsonl] [--concurrency 4] [--force] [paths ...]
+
+Results are appended to a JSONL file keyed by the sha256 of each story file,
+so a rerun skips stories that haven't changed and an interrupted run picks
+up where it stopped.
+"""
+import argparse
+import asyncio
+import glob
+import hashlib
+import os
+from datetime import datetime
 from llm_utils import *
+from storyDigest import compact_story
 
 def load_story_data(file_path):
     with open(file_path, "r", encoding="utf-8") as f:
         story_data = json.load(f)  # Load JSON data into a Python dictionary
     return story_data
 
-file_path = "Stories/EmbracingExhaustion.json"  # Path to your JSON file
-story_data = load_story_data(file_path)
 
-
-def evaluate_story(story_data: dict) -> dict:
+async def evaluate_story(story_data: dict) -> dict:
     metadata = story_data.get("storyMetadata", {})
     lines = story_data.get("lines", [])
     characters = story_data.get("characters", [])
     settings = story_data.get("settings", [])
     story_text = story_data.get("currentStoryText", "")
 
-    data = produce_score(story_data)
+    data = await produce_score(story_data)
     
     plot_cohesion_score = data.get("plotCohesion", 0)
     creativity_score = data.get("creativity", 0)
@@ -30,9 +43,6 @@ def evaluate_story(story_data: dict) -> dict:
 
     rank = score_to_rank(score_sum)
 
-    print(rank)
-    print(data)
-    
     return {
         "scoreDetails": {
             "plotCohesion": plot_cohesion_score,
@@ -46,10 +56,19 @@ def evaluate_story(story_data: dict) -> dict:
         "rank": rank
     }
 
-def produce_score(story_data):
-    prompt = f"""
+SCORE_CATEGORIES = ("plotCohesion", "creativity", "characters", "settingAtmosphere", "toneStyleAlignment", "completeness")
+
+SCORE_FORMAT = json_schema_format("story_score", {
+    category: {"type": "integer"} for category in SCORE_CATEGORIES
+})
+
+# Roughly how many tokens of story go into each scoring prompt
+SCORE_TOKEN_BUDGET = 3000
+
+def build_score_prompt(story_data: dict, token_budget: int = SCORE_TOKEN_BUDGET) -> str:
+    return f"""
         You are an evaluator of completed short stories.  
-        I will provide you with the final story data in JSON format, including metadata (genre, tone, style, etc.), the full text of the story, its characters, and settings.
+        I will provide you with the final story data, including metadata (genre, tone, style, etc.), the full text of the story, its characters, and settings.
 
         ### Task:
         1. Read and analyze all of the provided story data carefully.
@@ -68,13 +87,22 @@ def produce_score(story_data):
 
         No additional commentary. No code fences.
 
-        Here is the story data to evaluate: {story_data}
+        Here is the story data to evaluate:
+{compact_story(story_data, token_budget)}
 
         Remember, respond in **valid JSON** with the exact 6 keys described. No extra text or formatting.
         """
-    raw_data = call_llm_api(prompt)
-    data = json.loads(raw_data)
 
+async def produce_score(story_data):
+    """
+    Raises ValueError if the reply doesn't score all six categories, so the
+    story is left unscored and tried again on the next run.
+    """
+    prompt = build_score_prompt(story_data)
+    data = await call_llm_json(prompt, "story_score", SCORE_FORMAT)
+    missing = [category for category in SCORE_CATEGORIES if type(data.get(category)) not in (int, float)]
+    if missing:
+        raise ValueError(f"score reply is missing {', '.join(missing)}")
     return data
 
 def score_to_rank(score: int) -> str:
@@ -88,4 +116,113 @@ def score_to_rank(score: int) -> str:
     else:                     return "BEST STORY OF ALL TIME"
 
 
-evaluate_story(story_data)
\ No newline at end of file
+##########################################################
+######################## Batch ###########################
+##########################################################
+
+RESULTS_PATH = os.path.join("Stories", "rankings.jsonl")
+
+def content_hash(file_path: str) -> str:
+    with open(file_path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def load_results(results_path: str = RESULTS_PATH) -> dict:
+    """
+    content hash -> result record for every story already scored.
+    """
+    results = {}
+    if not os.path.exists(results_path):
+        return results
+    with open(results_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # A line torn by a killed run; later runs start on a new line
+                continue
+            results[record["hash"]] = record
+    return results
+
+def find_stories(root: str = "Stories") -> list:
+    return sorted(glob.glob(os.path.join(root, "**", "*.json"), recursive=True))
+
+async def rank_stories(paths: list, results_path: str = RESULTS_PATH, concurrency: int = 4, force: bool = False) -> list:
+    """
+    Score every story in paths that has no result for its current contents,
+    at most 'concurrency' at a time. Each result is appended (and flushed)
+    as soon as it is ready. Returns the new records.
+    """
+    done = {} if force else load_results(results_path)
+    pending = []
+    for path in paths:
+        digest = content_hash(path)
+        if digest in done:
+            continue
+        try:
+            story_data = load_story_data(path)
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"Skipping {path}: {e}")
+            continue
+        if not isinstance(story_data, dict) or "lines" not in story_data:
+            continue
+        pending.append((path, digest, story_data))
+
+    print(f"{len(pending)} to score, {len(paths) - len(pending)} skipped")
+    if not pending:
+        return []
+
+    os.makedirs(os.path.dirname(results_path) or ".", exist_ok=True)
+    semaphore = asyncio.Semaphore(concurrency)
+    records = []
+
+    with open(results_path, "a", encoding="utf-8") as results_file:
+        if results_file.tell() > 0:
+            with open(results_path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    # Don't append onto a line torn by a killed run
+                    results_file.write("\n")
+        async def score(path, digest, story_data):
+            async with semaphore:
+                try:
+                    result = await evaluate_story(story_data)
+                except Exception as e:
+                    print(f"Failed to score {path}: {e}")
+                    return
+            record = {
+                "hash": digest,
+                "path": os.path.normpath(path),
+                "title": story_data.get("title", ""),
+                "scoredAt": datetime.utcnow().isoformat(),
+                **result,
+            }
+            # Written from the event loop thread only, so lines never interleave
+            results_file.write(json.dumps(record) + "\n")
+            results_file.flush()
+            os.fsync(results_file.fileno())
+            records.append(record)
+            print(f"{record['rank']:>4} {record['totalScore']:>3}  {record['title'] or path}")
+
+        await asyncio.gather(*(score(*item) for item in pending))
+
+    return records
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs="*", help="Story JSON files to score (default: everything under --root)")
+    parser.add_argument("--root", default="Stories")
+    parser.add_argument("--results", default=RESULTS_PATH)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--force", action="store_true", help="Rescore stories that already have a result")
+    args = parser.parse_args()
+
+    async def run():
+        try:
+            await rank_stories(args.paths or find_stories(args.root), args.results, args.concurrency, args.force)
+        finally:
+            await close_client()
+
+    asyncio.run(run())
+
+if __name__ == "__main__":
+    main()
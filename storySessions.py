@@ -0,0 +1,65 @@
+class StorySession():
+    """
+    Everything one channel's story needs between commands:
+    who joined, how long the story is, its personality and whose turn it is.
+    """
+    def __init__(self, guild_id, channel_id, length: int):
+        self.guild_id = guild_id
+        self.channel_id = channel_id
+        self.length = length
+        self.users = set()
+        self.personality = None
+        self.story_id = None
+        self.turn = 1
+        self.running = False
+        # The task writing the story, and whether !cancel stopped it
+        self.task = None
+        self.cancelled = False
+
+    @property
+    def key(self):
+        return (self.guild_id, self.channel_id)
+
+    def to_dict(self) -> dict:
+        # What the journal keeps so the session can be resumed after a restart
+        return {
+            "guildId": self.guild_id,
+            "channelId": self.channel_id,
+            "length": self.length,
+            "personality": self.personality,
+            "userIds": [user.id for user in self.users],
+        }
+
+
+class SessionManager():
+    """
+    Story sessions keyed by (guild id, channel id), so every channel can run its
+    own story and each command finds its session with a single dict lookup.
+    """
+    def __init__(self):
+        self.sessions = {}
+
+    @staticmethod
+    def key_for(ctx):
+        guild_id = ctx.guild.id if ctx.guild is not None else None
+        return (guild_id, ctx.channel.id)
+
+    def create(self, ctx, length: int) -> StorySession:
+        guild_id, channel_id = self.key_for(ctx)
+        return self.create_for(guild_id, channel_id, length)
+
+    def create_for(self, guild_id, channel_id, length: int) -> StorySession:
+        session = StorySession(guild_id, channel_id, length)
+        self.sessions[session.key] = session
+        return session
+
+    def get(self, ctx):
+        return self.sessions.get(self.key_for(ctx))
+
+    def end(self, session: StorySession):
+        # Only drop the entry if a newer !story hasn't already replaced it
+        if self.sessions.get(session.key) is session:
+            del self.sessions[session.key]
+
+    def __len__(self):
+        return len(self.sessions)
@@ -0,0 +1,66 @@
+import asyncio
+import time
+
+
+class TaskGraph():
+    """
+    A handful of async steps and the steps each one needs first. run()
+    starts every step as soon as its dependencies are done, so independent
+    steps overlap, and times each one.
+
+        graph = TaskGraph()
+        graph.add("line", lambda: make_line())
+        graph.add("image", lambda line: make_image(line), after=["line"])
+        graph.add("video", lambda: make_video())
+        results = await graph.run()
+
+    A step is called with its dependencies' results, in the order given in
+    after. Steps can only depend on steps added before them, so the graph
+    can't have a cycle.
+    """
+    def __init__(self):
+        self.steps = {}
+        self.results = {}
+        # step -> seconds it ran for, plus "total" for the whole graph
+        self.timings = {}
+
+    def add(self, name: str, step, after=()):
+        if name in self.steps or name == "total":
+            raise ValueError(f"step {name!r} is already defined")
+        for dependency in after:
+            if dependency not in self.steps:
+                raise ValueError(f"step {name!r} depends on {dependency!r}, which hasn't been added")
+        self.steps[name] = (step, tuple(after))
+
+    async def _run_step(self, name: str, tasks: dict):
+        step, after = self.steps[name]
+        args = [await tasks[dependency] for dependency in after]
+        start = time.perf_counter()
+        try:
+            return await step(*args)
+        finally:
+            self.timings[name] = round(time.perf_counter() - start, 3)
+
+    async def run(self) -> dict:
+        """
+        Run every step and return their results by name. If a step fails
+        the rest are cancelled and its exception is raised.
+        """
+        start = time.perf_counter()
+        tasks = {}
+        for name in self.steps:
+            tasks[name] = asyncio.ensure_future(self._run_step(name, tasks))
+        try:
+            await asyncio.gather(*tasks.values())
+        except BaseException:
+            for task in tasks.values():
+                task.cancel()
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+            raise
+        finally:
+            self.timings["total"] = round(time.perf_counter() - start, 3)
+        self.results = {name: task.result() for name, task in tasks.items()}
+        return self.results
+
+    def report(self) -> str:
+        return ", ".join(f"{name} {seconds:.2f}s" for name, seconds in self.timings.items())